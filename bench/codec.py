@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""bench/codec.py
+
+Micro-benchmarks for the cloudscraper JSON codec.
+
+Builds node list and client history responses shaped like those returned by
+the CloudTrax API, and times decoding them and encoding the nested node and
+client columns, with the standard json module as it was used before, and
+with the codec over each of the installed JSON libraries.
+
+Run from the top of the source tree:
+
+    python bench/codec.py [--nodes N] [--clients N] [--repeat N]
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.codec import Codec, get_libraries
+
+
+NODE_COLUMNS = (
+        'lan_info', 'selected_gateway', 'gateway_path', 'channels',
+        'ht_modes', 'neighbors', 'traffic')
+CLIENT_COLUMNS = ('bitrate', 'mcs', 'signal', 'traffic')
+
+
+def make_mac(prefix, index):
+    return '{}:{:02x}:{:02x}:{:02x}'.format(
+            prefix, (index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)
+
+
+def make_traffic(index):
+    return dict(
+            ('ssid{}'.format(ssid), {
+                'bdown': index * 104729 + ssid,
+                'bup': index * 7919 + ssid,
+                'cdown': index + ssid,
+                'cup': index * 2 + ssid,
+                })
+            for ssid in range(1, 3))
+
+
+def make_node(index):
+    """Return the data for a node, as in /node/network/<id>/list."""
+    gateway = index % 10 == 0
+    return {
+            'name': 'Node {}'.format(index),
+            'description': '',
+            'role': 'gateway' if gateway else 'repeater',
+            'spare': False,
+            'down': index % 50 == 0,
+            'mac': make_mac('ac:86:74', index),
+            'ip': '5.{}.{}.1'.format((index >> 8) & 0xff, index & 0xff),
+            'lan_info': {
+                'ipv4': {
+                    'ip': '192.168.1.{}'.format(index % 250 + 2),
+                    'netmask': '255.255.255.0',
+                    'gateway': '192.168.1.1',
+                    'dns': ['8.8.8.8', '8.8.4.4'],
+                    },
+                } if gateway else None,
+            'anonymous_ip': '10.{}.{}.1'.format(
+                (index >> 8) & 0xff, index & 0xff),
+            'selected_gateway': None if gateway else {
+                'node_id': index - index % 10,
+                'hops': 1 + index % 3,
+                },
+            'gateway_path': [] if gateway else [
+                {'node_id': index - index % 10 + x, 'rssi': -40 - x}
+                for x in range(index % 3)],
+            'channels': {'2_4GHz': 6, '5GHz': 149},
+            'ht_modes': {'2_4GHz': 'HT20', '5GHz': 'VHT80'},
+            'hardware': 'OM5P-AC',
+            'flags': '0x0',
+            'latitude': -34.7 + index * 1e-5,
+            'longitude': 149.7 + index * 1e-5,
+            'mesh_version': 'batman-adv',
+            'connection_keeper_status': 'connected',
+            'custom_sh_approved': False,
+            'expedite_upgrade': False,
+            'firmware_version': 'fw-ng-r589',
+            'neighbors': [
+                {
+                    'node_id': index + x,
+                    'rssi': -50 - x * 5,
+                    'ip': '5.0.0.{}'.format(x),
+                    'rx_rate': 130,
+                    'tx_rate': 117,
+                    }
+                for x in range(1, 4)],
+            'load': 0.12,
+            'memfree': 21348,
+            'upgrade_status': None,
+            'last_checkin': '2016-06-01T10:15:00Z',
+            'uptime': '3d 4h 12m',
+            'traffic': make_traffic(index),
+            }
+
+
+def make_client(index):
+    """Return the data for a client, as in /history/network/<id>/clients."""
+    return {
+            'cid': 'c{}'.format(index),
+            'band': '5GHz' if index % 2 else '2.4GHz',
+            'bitrate': {'rx': 144.4, 'tx': 130.0},
+            'channel_width': 40,
+            'link': 'wifi',
+            'mcs': {'rx': 15, 'tx': 14},
+            'signal': {'antenna1': -61, 'antenna2': -63},
+            'traffic': make_traffic(index),
+            'wifi_mode': 'n',
+            'last_name': 'client-{}'.format(index),
+            'last_node': make_mac('ac:86:74', index % 500),
+            'last_seen': '2016-06-01T10:14:00Z',
+            'name': None,
+            'name_override': None,
+            'blocked': False,
+            'os': 'Android',
+            'os_version': '6.0',
+            }
+
+
+def run(name, func, repeat, size):
+    """Time a function and print the best result per item."""
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    print('{:<40} {:>10.1f} ms {:>8.2f} us/item'.format(
+        name, best * 1000, best * 1e6 / size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON codec benchmarks')
+    parser.add_argument('--nodes', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    nodes = dict(
+            (str(x), make_node(x)) for x in range(1, args.nodes + 1))
+    clients = dict(
+            (make_mac('c0:ff:ee', x), make_client(x))
+            for x in range(1, args.clients + 1))
+    bodies = [
+            ('nodes', json.dumps({'nodes': nodes}).encode('utf-8'),
+                args.nodes),
+            ('clients', json.dumps({'clients': clients}).encode('utf-8'),
+                args.clients),
+            ]
+    columns = [
+            ('nodes', [
+                [data[x] for x in NODE_COLUMNS] for data in nodes.values()],
+                args.nodes),
+            ('clients', [
+                [data[x] for x in CLIENT_COLUMNS]
+                for data in clients.values()],
+                args.clients),
+            ]
+
+    print('Libraries installed: {}'.format(', '.join(get_libraries())))
+    for label, body, size in bodies:
+        print('\nDecode {} response ({} KB)'.format(label, len(body) // 1024))
+        run('json.loads(text)',
+                lambda: json.loads(body.decode('utf-8')), args.repeat, size)
+        for name in get_libraries():
+            codec = Codec(name)
+            run('{} loads(content)'.format(name),
+                    lambda: codec.loads(body), args.repeat, size)
+
+    for label, rows, size in columns:
+        print('\nEncode {} columns'.format(label))
+        run('json.dumps',
+                lambda: [[json.dumps(x) for x in row] for row in rows],
+                args.repeat, size)
+        for name in get_libraries():
+            codec = Codec(name)
+            run('{} dumps'.format(name),
+                    lambda: [[codec.dumps(x) for x in row] for row in rows],
+                    args.repeat, size)
+
+
+if __name__ == '__main__':
+    main()
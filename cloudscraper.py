@@ -11,19 +11,176 @@ Authors:
     Alex Ferrara <alex@receptiveit.com.au>
     Brendan Jurd <direvus@gmail.com>
 """
+from lib.archive import Replay, get_run_name
+from lib.backfill import Backfill
+from lib.checkpoint import Checkpoint, COLLECTED, STORED
 from lib.cloudtrax import CloudTrax
 from lib.config import Config
-from lib.database import get_connection
-from lib.mail import Email
+from lib.database import MigrationInProgress, get_connection
+from lib.events import Differ, write_events
+from lib.export import Exporter
+from lib.mail import Mailer, to_unicode
+from lib.quota import Quota
+from lib.report import Report
+from lib.schedule import Scheduler
+from lib.service import Service
+from lib.stats import Stats, is_available as stats_available
+from lib.workers import run_parallel
 
 import argparse
 import datetime
 import logging
+import os
+import sys
 
 
 LOGFORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 
 
+def get_cloudtraxes(config, args, run):
+    """Return a CloudTrax instance for each configured API account.
+
+    Every instance archives its responses under the same 'run' name.
+    """
+    cloudtraxes = []
+    for account in config.get_accounts():
+        replay = None
+        if args.replay:
+            path = args.replay
+            if account is not None:
+                path = os.path.join(path, account)
+            replay = Replay(path)
+        cloudtraxes.append(CloudTrax(config, replay, account, run))
+    return cloudtraxes
+
+
+def collect(config, database, args):
+    """Collect data from CloudTrax, store it and check gateway quotas.
+
+    The networks of each account are worked through a batch at a time.  The
+    current batch of each account is collected concurrently, and then stored
+    in turn into the same database, with the progress of each network
+    recorded in the run checkpoint.
+
+    When replaying an archived run, the data is stored and statistics
+    computed, but the polling schedule, checkpoint, change events and gateway
+    quotas are left alone, as the data is not current.
+    """
+    cloudtraxes = get_cloudtraxes(config, args, get_run_name())
+    workers = len(cloudtraxes)
+
+    run_parallel(lambda x: x.collect_networks(), cloudtraxes, workers)
+    scheduler = None
+    if config.get_schedule() and not args.replay:
+        scheduler = Scheduler(config, database)
+        for cloudtrax in cloudtraxes:
+            due = scheduler.get_due(cloudtrax.get_networks())
+            cloudtrax.networks = dict((net.id, net) for net in due)
+    checkpoint = Checkpoint(config, None if args.replay else database)
+    batches = [checkpoint.get_batches(x.get_networks()) for x in cloudtraxes]
+
+    def collect_batch(item):
+        cloudtrax, networks = item
+        cloudtrax.reset(networks)
+        cloudtrax.collect_nodes()
+        if not args.no_history:
+            cloudtrax.collect_node_history()
+            cloudtrax.collect_clients()
+        cloudtrax.build_topology()
+
+    eventconf = config.get_events()
+    differ = None
+    if eventconf and not args.replay:
+        differ = Differ(eventconf['state'])
+    quota = None
+    if not args.replay:
+        quota = Quota(config)
+    stats = not args.no_history
+    if stats and not stats_available():
+        logging.warning("numpy is not available, "
+                "node statistics will not be computed.")
+        stats = False
+
+    for index in range(max([len(x) for x in batches] + [0])):
+        current = [
+                (cloudtrax, networks[index])
+                for cloudtrax, networks in zip(cloudtraxes, batches)
+                if index < len(networks)]
+        run_parallel(collect_batch, current, len(current))
+        for cloudtrax, networks in current:
+            checkpoint.mark(networks, COLLECTED)
+
+        for cloudtrax, networks in current:
+            logging.info("Storing data for %r", cloudtrax)
+            database.store_data(cloudtrax)
+            if stats:
+                database.store_stats(Stats(cloudtrax.get_nodes()))
+            if scheduler is not None:
+                scheduler.update(cloudtrax.get_networks())
+            if differ is not None:
+                events = differ.diff(cloudtrax)
+                database.store_events(events)
+                if 'log' in eventconf:
+                    write_events(eventconf['log'], events)
+            if quota is not None:
+                quota.update(cloudtrax, database)
+            checkpoint.mark(networks, STORED)
+        if differ is not None:
+            differ.save()
+
+    for cloudtrax in cloudtraxes:
+        cloudtrax.close()
+    checkpoint.finish()
+    database.store_ingest_run(sum(len(x) for y in batches for x in y))
+    if quota is not None and quota.alerts:
+        emailconf = config.get_email()
+        emails = quota.get_emails(emailconf)
+        failed = Mailer(emailconf).send(emails)
+        if failed:
+            logging.error("%s of %s quota alerts could not be sent",
+                    failed, len(emails))
+
+
+def backfill(config, database, args):
+    """Backfill node history for networks not yet backfilled."""
+    cloudtraxes = get_cloudtraxes(config, args, get_run_name())
+    run_parallel(lambda x: x.collect_networks(), cloudtraxes, len(cloudtraxes))
+    Backfill(config, database).run(cloudtraxes)
+    for cloudtrax in cloudtraxes:
+        cloudtrax.close()
+    database.store_ingest_run(sum(len(x.networks) for x in cloudtraxes))
+
+
+def lookup_client(database, mac):
+    """Print the networks a client MAC address has been seen on."""
+    rows = database.get_client_presence(mac)
+    if not rows:
+        print('Client {} has not been seen.'.format(mac))
+    for network, name, node, first_seen, last_seen in rows:
+        line = u'{} {} ({}): node {}, first seen {}, last seen {}'.format(
+            to_unicode(mac), to_unicode(name), network, node,
+            first_seen, last_seen)
+        print(line.encode('utf-8'))
+
+
+def report(config, database):
+    """Compose and send email reports from the stored data."""
+    emails = Report(database, config).get_emails()
+    failed = Mailer(config.get_email()).send(emails)
+    if failed:
+        logging.error("%s of %s reports could not be sent",
+                failed, len(emails))
+
+
+def export(config, database):
+    """Export new rows from the log tables to Parquet files."""
+    exportconf = config.get_export()
+    if 'path' not in exportconf:
+        raise ValueError("Exporting requires a 'path' in the [export] config.")
+    exporter = Exporter(database, **exportconf)
+    exporter.export()
+
+
 parser = argparse.ArgumentParser(description='CloudTrax API scraper')
 parser.add_argument(
         '-c', '--config',
@@ -40,6 +197,32 @@ parser.add_argument(
         '-n', '--no-history',
         action='store_true',
         help='do not collect historical data')
+parser.add_argument(
+        '-r', '--report',
+        action='store_true',
+        help='send email reports from stored data instead of collecting')
+parser.add_argument(
+        '-e', '--export',
+        action='store_true',
+        help='export log tables to Parquet files instead of collecting')
+parser.add_argument(
+        '-b', '--backfill',
+        action='store_true',
+        help='backfill node history instead of collecting')
+parser.add_argument(
+        '-s', '--serve',
+        action='store_true',
+        help='serve dashboard queries over HTTP instead of collecting')
+parser.add_argument(
+        '--client',
+        metavar='mac',
+        help='show the networks a client has been seen on and exit')
+parser.add_argument(
+        '--replay',
+        metavar='directory',
+        help='store an archived run instead of collecting from the API, '
+            'without updating gateway quotas, change events or the '
+            'polling schedule')
 args = parser.parse_args()
 
 if args.verbose > 1:
@@ -52,12 +235,21 @@ else:
 logging.basicConfig(level=loglevel, format=LOGFORMAT)
 
 config = Config(args.config)
-cloudtrax = CloudTrax(config)
-cloudtrax.collect_networks()
-cloudtrax.collect_nodes()
-if not args.no_history:
-    cloudtrax.collect_node_history()
-    cloudtrax.collect_clients()
 dbconf = config.get_db()
-database = get_connection(dbconf['type'], **dbconf)
-database.store_data(cloudtrax)
+try:
+    database = get_connection(dbconf['type'], **dbconf)
+except MigrationInProgress as e:
+    logging.warning("%s Try again once it has finished.", e)
+    sys.exit(1)
+if args.client:
+    lookup_client(database, args.client)
+elif args.serve:
+    Service(database, config).serve()
+elif args.report:
+    report(config, database)
+elif args.export:
+    export(config, database)
+elif args.backfill:
+    backfill(config, database, args)
+else:
+    collect(config, database, args)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/archive.py
+
+Raw API response archive for cloudscraper.
+
+An Archive records every response body from the CloudTrax API exactly as it
+was received, in gzip-compressed, append-only files: one directory per run,
+and one file per endpoint within it.  A Replay reads a run directory back and
+answers API requests from it, so that a run can be repeated offline, at disk
+speed and without spending API quota.
+
+Each record in an archive file is a one-line JSON header giving the request
+path, content type and body length, followed by the raw body and a newline.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+
+
+SUFFIX = '.gz'
+
+
+def get_endpoint(path):
+    """Return the archive file name for an API request path.
+
+    IDs and query parameters are dropped, so that for example all requests
+    to '/node/network/<id>/list' share the file 'node_network_list.gz'.
+    """
+    path = path.split('?', 1)[0]
+    parts = [x for x in path.split('/') if x and not x.isdigit()]
+    return re.sub(r'[^\w.-]', '_', '_'.join(parts)) + SUFFIX
+
+
+def get_run_name():
+    """Return the archive directory name for a run starting now."""
+    return datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+
+
+class Archive(object):
+    """Append-only writer for raw API responses."""
+    def __init__(self, path, name=None):
+        if name is None:
+            name = get_run_name()
+        self.path = os.path.join(path, name)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.files = dict()
+        self.lock = threading.Lock()
+        logging.info("Archiving API responses to %s", self.path)
+
+    def write(self, path, content_type, body):
+        """Append a response body to the archive."""
+        header = json.dumps({
+            'path': path,
+            'type': content_type,
+            'length': len(body),
+            })
+        endpoint = get_endpoint(path)
+        with self.lock:
+            if endpoint not in self.files:
+                self.files[endpoint] = gzip.open(
+                        os.path.join(self.path, endpoint), 'ab')
+            fp = self.files[endpoint]
+            fp.write(header + '\n')
+            fp.write(body)
+            fp.write('\n')
+
+    def close(self):
+        """Close all archive files."""
+        with self.lock:
+            for fp in self.files.values():
+                fp.close()
+            self.files = dict()
+
+
+def read_archive(filename):
+    """Generate (path, content type, body) for each record in a file."""
+    with gzip.open(filename, 'rb') as fp:
+        while True:
+            line = fp.readline()
+            if not line:
+                return
+            header = json.loads(line)
+            body = fp.read(header['length'])
+            fp.read(1)
+            yield header['path'], header['type'], body
+
+
+class Replay(object):
+    """Answers API requests from an archived run."""
+    def __init__(self, path):
+        self.path = path
+        self.responses = dict()
+        for name in sorted(os.listdir(path)):
+            if not name.endswith(SUFFIX):
+                continue
+            for reqpath, content_type, body in read_archive(
+                    os.path.join(path, name)):
+                self.responses[reqpath] = (content_type, body)
+        logging.info("Loaded %s archived responses from %s",
+                len(self.responses), path)
+
+    def get(self, path):
+        """Return the (content type, body) archived for a path, or None."""
+        return self.responses.get(path)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/backfill.py
+
+Historical backfill module for cloudscraper.
+
+A normal run only collects the last day of node history.  When a network is
+first onboarded, a backfill collects as much history as the API will give,
+by requesting each of the longer history periods in turn.  The work is split
+into one task per network and period, which are fetched in parallel and
+bulk-loaded into node_checkin.  Samples from overlapping periods are merged
+into the same rows rather than duplicated.
+
+Finished tasks are recorded in the database, so an interrupted backfill
+carries on where it stopped, and running a backfill again only fetches the
+history of networks added since.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+from lib.workers import run_parallel
+import logging
+
+
+def get_checkin_rows(history):
+    """Return deduplicated node_checkin rows from a raw node history.
+
+    Checkins and metrics for the same node and time are merged into a single
+    (node, time, status, speed) row, in the same way as Node.add_checkin.
+    """
+    samples = dict()
+    for nodeid, data in history.get('nodes', {}).iteritems():
+        nodeid = int(nodeid)
+        for sample in data.get('checkins', []) + data.get('metrics', []):
+            key = (nodeid, sample['time'])
+            row = samples.setdefault(key, [None, None])
+            if sample.get('status') is not None:
+                row[0] = sample['status']
+            if sample.get('speed') is not None:
+                row[1] = sample['speed']
+    return [key + tuple(row) for key, row in samples.iteritems()]
+
+
+class Backfill(object):
+    """Parallel, resumable node history backfill.
+
+    Settings are taken from the [backfill] config: 'periods', a
+    comma-separated list of the history periods to request, and 'workers',
+    the number of requests to run in parallel.
+    """
+    def __init__(self, config, database):
+        conf = config.get_backfill()
+        self.database = database
+        self.periods = [x.strip() for x in conf.get(
+            'periods', 'month, week, day').split(',') if x.strip()]
+        self.workers = int(conf.get('workers', 4))
+
+    def get_tasks(self, cloudtraxes):
+        """Return the (CloudTrax, network ID, period) tasks not yet done."""
+        done = self.database.get_backfill_progress()
+        tasks = []
+        for cloudtrax in cloudtraxes:
+            for netid in sorted(cloudtrax.networks.keys()):
+                for period in self.periods:
+                    if (netid, period) not in done:
+                        tasks.append((cloudtrax, netid, period))
+        return tasks
+
+    def fetch(self, task):
+        """Fetch the history for a task and return its checkin rows."""
+        cloudtrax, netid, period = task
+        return get_checkin_rows(cloudtrax.get_node_history(netid, period))
+
+    def run(self, cloudtraxes):
+        """Backfill node history for the networks of each CloudTrax.
+
+        The networks must already have been collected.  Tasks are fetched a
+        chunk at a time, and each task's rows are loaded and marked as done
+        before moving on, so that only a chunk's worth of history is ever
+        held in memory.
+        """
+        tasks = self.get_tasks(cloudtraxes)
+        logging.info("Backfilling %s network history periods", len(tasks))
+        chunk = self.workers * 4
+        for start in range(0, len(tasks), chunk):
+            batch = tasks[start:start + chunk]
+            results = run_parallel(self.fetch, batch, self.workers)
+            for (cloudtrax, netid, period), rows in zip(batch, results):
+                logging.info("Loading %s checkins for network %s (%s)",
+                        len(rows), netid, period)
+                self.database.store_checkins(rows)
+                self.database.store_backfill_progress(netid, period)
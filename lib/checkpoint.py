@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/checkpoint.py
+
+Run checkpoint module for cloudscraper.
+
+A collection run works through the networks of each account a batch at a
+time: each batch is collected and then stored before the next is started, and
+the phase each network has reached ('collected' or 'stored') is recorded in
+the database as it goes.  If the run dies part way through, the next run skips
+the networks that were already stored, and collects only the remainder.
+
+A run which finishes clears its checkpoint.  The checkpoint of an unfinished
+run is only honoured for a limited time, so that a run which died long ago
+does not cause networks to be skipped.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+import logging
+
+
+COLLECTED = 'collected'
+STORED = 'stored'
+
+
+def get_batches(items, size):
+    """Return a list of lists of at most 'size' items each."""
+    items = list(items)
+    if size < 1:
+        return [items] if items else []
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class Checkpoint(object):
+    """Per-network progress of a collection run.
+
+    Settings are taken from the [checkpoint] config: 'batch', the number of
+    networks per account to collect and store at a time (0 for all at once),
+    and 'max_age', the number of minutes for which the checkpoint of an
+    unfinished run is honoured.
+
+    With no database, as when replaying an archived run, nothing is recorded
+    and no networks are skipped.
+    """
+    def __init__(self, config, database):
+        conf = config.get_checkpoint()
+        self.database = database
+        self.batch = int(conf.get('batch', 20))
+        self.max_age = int(conf.get('max_age', 60))
+        self.phases = dict()
+        if self.database is not None:
+            self.phases = self.database.get_checkpoint(self.max_age)
+        stored = [k for k, v in self.phases.iteritems() if v == STORED]
+        if stored:
+            logging.warning(
+                    "Resuming an unfinished run, skipping %s stored networks",
+                    len(stored))
+
+    def get_pending(self, networks):
+        """Return the Networks which have not yet been stored by this run."""
+        return [net for net in networks if self.phases.get(net.id) != STORED]
+
+    def get_batches(self, networks):
+        """Return the pending Networks split into batches."""
+        return get_batches(sorted(self.get_pending(networks)), self.batch)
+
+    def mark(self, networks, phase):
+        """Record that Networks have reached a phase of the run."""
+        networks = [net.id for net in networks]
+        if self.database is None or not networks:
+            return
+        self.database.store_checkpoint(networks, phase)
+        for netid in networks:
+            self.phases[netid] = phase
+
+    def finish(self):
+        """Clear the checkpoint at the end of a successful run."""
+        if self.database is not None:
+            self.database.clear_checkpoint()
+        self.phases = dict()
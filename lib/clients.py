@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/clients.py
+
+Client index module for cloudscraper.
+
+The API reports clients network by network, so a device which roams between
+networks appears once in each of them.  A ClientIndex gathers the clients
+collected from every network under the device's MAC address, so that all the
+sightings of a device are a single dictionary lookup.
+
+The index is also stored as the client_presence table, with the first and
+last time each device was seen on each network, so that a device can be
+followed across runs without scanning client_log.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+
+
+class ClientIndex(object):
+    """Index of Client objects by MAC address across networks."""
+    def __init__(self, clients=()):
+        self.by_mac = dict()
+        self.count = 0
+        for client in clients:
+            self.add(client)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for networks in self.by_mac.itervalues():
+            for client in networks.itervalues():
+                yield client
+
+    def __contains__(self, mac):
+        return mac.lower() in self.by_mac
+
+    def add(self, client):
+        """Add a Client to the index."""
+        networks = self.by_mac.setdefault(client.mac.lower(), dict())
+        if client.network not in networks:
+            self.count += 1
+        networks[client.network] = client
+
+    def get(self, mac):
+        """Return a dict of network ID to Client for a MAC address."""
+        return self.by_mac.get(mac.lower(), {})
+
+    def get_networks(self, mac):
+        """Return the IDs of the networks a MAC address was seen on."""
+        return sorted(self.get(mac).keys())
+
+    def get_last_seen(self, mac):
+        """Return the Client with the latest sighting of a MAC address."""
+        clients = [x for x in self.get(mac).values() if x.last_seen]
+        if not clients:
+            return None
+        return max(clients, key=lambda x: x.last_seen)
+
+    def get_roaming(self):
+        """Return the MAC addresses seen on more than one network."""
+        return [k for k, v in self.by_mac.iteritems() if len(v) > 1]
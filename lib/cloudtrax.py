@@ -17,13 +17,19 @@ Authors:
     Alex Ferrara <alex@receptiveit.com.au>
     Brendan Jurd <direvus@gmail.com>
 """
+from lib.archive import Archive, get_run_name
+from lib.clients import ClientIndex
+from lib.codec import loads
+from lib.topology import Topology
 from random import choice
 import hashlib
 import hmac
 import json
 import logging
+import os
 import requests
 import string
+import threading
 import time
 
 
@@ -36,6 +42,25 @@ def make_nonce(length=32):
     return ''.join([choice(NONCE_CHARS) for x in range(length)])
 
 
+def get_node_ref(value):
+    """Return the node ID referred to by an API value, or None.
+
+    The API refers to other nodes either by bare ID, or by an object carrying
+    the ID along with details of the link.
+    """
+    if isinstance(value, dict):
+        for key in ('node_id', 'id', 'node'):
+            if key in value:
+                value = value[key]
+                break
+        else:
+            return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
 class CloudTrax(object):
     """CloudTrax API connector.
 
@@ -43,31 +68,83 @@ class CloudTrax(object):
     about networks, nodes, clients and historical statistics, and stores them
     as objects, from whence they are available for reporting or insertion into
     persistent storage.
+
+    The API settings are read from the [api] section of the config, or for a
+    named account, from the [api:<name>] section.  If the section sets a
+    'rate_limit', requests are spaced out to stay within that many per
+    minute.
+
+    If the API config has an 'archive' directory, every raw response is
+    recorded there.  Given a Replay, responses are instead read back from an
+    archived run, and the API is not contacted at all.  Where several
+    accounts are collected in one run, they should be given the same 'run'
+    name, so that their archives are kept together in one run directory.
     """
-    def __init__(self, config):
+    def __init__(self, config, replay=None, account=None, run=None):
         self.networks = dict()
         self.nodes = dict()
         self.clients = dict()
+        self.client_index = ClientIndex()
         self.usage = [0, 0]
         self.alerting = []
+        self.topology = None
 
         self.config = config
-        self.url = self.config.get('api', 'url')
+        self.account = account
+        if account is None:
+            self.section = 'api'
+        else:
+            self.section = 'api:{}'.format(account)
+        self.url = self.config.get(self.section, 'url')
         if self.url.endswith('/'):
             self.url = self.url[:-1]
 
-        self.key = self.config.get('api', 'key')
-        self.secret = self.config.get('api', 'secret')
-        self.version = self.config.get('api', 'version')
+        self.key = self.config.get(self.section, 'key')
+        self.secret = self.config.get(self.section, 'secret')
+        self.version = self.config.get(self.section, 'version')
+
+        self.request_interval = 0
+        self.last_request = 0
+        self.lock = threading.Lock()
+        if self.config.has_option(self.section, 'rate_limit'):
+            self.request_interval = 60.0 / self.config.getfloat(
+                    self.section, 'rate_limit')
+
+        self.replay = replay
+        self.archive = None
+        if replay is None and self.config.has_option(self.section, 'archive'):
+            name = run or get_run_name()
+            if account is not None:
+                name = os.path.join(name, account)
+            self.archive = Archive(
+                    self.config.get(self.section, 'archive'), name)
+
+    def __repr__(self):
+        return 'CloudTrax {}'.format(self.account or 'default')
 
     def request(self, path, method='GET', data=None):
         """Issue a request to the CloudTrax API and return the response content."""
+        if self.replay is not None:
+            archived = self.replay.get(path)
+            if archived is None:
+                logging.warning("%s %s not found in archive", method, path)
+                return dict()
+            logging.info("%s %s (replay)", method, path)
+            return self.decode(*archived)
+
         funcname = method.lower()
         if not hasattr(requests, funcname):
             logging.error("Invalid method type %s: No such function in 'requests'.", method)
 
         url = self.url + path
 
+        if self.request_interval:
+            with self.lock:
+                wait = self.last_request + self.request_interval - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                self.last_request = time.time()
+
         auth = 'key={},timestamp={},nonce={}'.format(
                 self.key,
                 int(round(time.time())),
@@ -91,21 +168,47 @@ class CloudTrax(object):
         func = getattr(requests, funcname)
         response = func(url, headers=headers, data=jsondata)
         if response.ok:
-            if response.headers['content-type'] == 'application/json':
-                return json.loads(response.text)
-            else:
-                return response.text
+            content_type = response.headers['content-type']
+            if self.archive is not None:
+                self.archive.write(path, content_type, response.content)
+            return self.decode(content_type, response.content)
         else:
             logging.error("%s %s %s",
                     response.status_code, response.reason, response.text)
             exit(response.status_code)
 
+    def decode(self, content_type, body):
+        """Return the content of a raw response body."""
+        if content_type == 'application/json':
+            return loads(body)
+        else:
+            return body
+
+    def close(self):
+        """Finish writing the response archive, if any."""
+        if self.archive is not None:
+            self.archive.close()
+
+    def reset(self, networks):
+        """Replace the collected networks, discarding their nodes and clients.
+
+        This allows the same instance to collect a batch of networks at a
+        time.
+        """
+        self.networks = dict((net.id, net) for net in networks)
+        self.nodes = dict()
+        self.clients = dict()
+        self.client_index = ClientIndex()
+        self.alerting = []
+        self.topology = None
+
     def collect_networks(self):
         """Assemble network information from CloudTrax."""
         nets = self.request('/network/list')
         logging.info("Got %s networks", len(nets['networks']))
         for data in nets['networks']:
             network = Network(**data)
+            network.account = self.account
             self.networks[network.id] = network
 
     def collect_nodes(self):
@@ -113,16 +216,25 @@ class CloudTrax(object):
         path = '/node/network/{}/list'
         for netid in self.networks.keys():
             nodes = self.request(path.format(netid))
+            if 'nodes' not in nodes:
+                continue
             logging.info("Got %s nodes for network %s.", len(nodes['nodes']), netid)
             for key, data in nodes['nodes'].iteritems():
                 node = Node(key, netid, **data)
                 self.nodes[node.id] = node
 
+    def get_node_history(self, netid, period='day'):
+        """Return the raw node history of a network over a period.
+
+        The API accepts 'day', 'week' and 'month' periods.
+        """
+        path = '/history/network/{}/nodes?period={}'
+        return self.request(path.format(netid, period))
+
     def collect_node_history(self):
         """Assemble 24hour node history for each network from CloudTrax."""
-        path = '/history/network/{}/nodes?period=day'
         for netid in self.networks.keys():
-            history = self.request(path.format(netid))
+            history = self.get_node_history(netid)
             if 'nodes' not in history:
                 continue
             for nodeid, data in history['nodes'].iteritems():
@@ -151,6 +263,12 @@ class CloudTrax(object):
             for key, data in clients['clients'].iteritems():
                 client = Client(key, netid, **data)
                 self.clients[netid][client.mac] = client
+                self.client_index.add(client)
+
+    def build_topology(self):
+        """Index the mesh topology of the collected nodes."""
+        self.topology = Topology(self.get_nodes())
+        return self.topology
 
     def get_alerting(self):
         """Return a list of alerting nodes"""
@@ -165,8 +283,8 @@ class CloudTrax(object):
         return self.nodes.values()
 
     def get_clients(self):
-        """Return a list of the collected Client objects."""
-        return [c for n in self.clients.values() for c in n.values()]
+        """Return the collected Client objects, from the client index."""
+        return self.client_index
 
 
 class Network(object):
@@ -194,6 +312,7 @@ class Network(object):
         self.is_fcc = is_fcc
         self.location = (latitude, longitude)
         self.latest_firmware_version = latest_firmware_version
+        self.account = None
 
     def __cmp__(self, other):
         return cmp(self.id, other.id)
@@ -244,7 +363,6 @@ class Node(object):
             ):
         self.checkins = dict()
         self.traffic = dict()
-        self.status_checkins = {'none': 0}
 
         self.id = int(id)
         self.network = network
@@ -306,7 +424,8 @@ class Node(object):
         If speed is None, then either there was no checkin, or no traffic,
         during the time sample.
 
-        We maintain a frequency count of each status as checkins are added.
+        The history reports checkins and metrics separately, so a sample
+        may be added more than once, and the values are merged.
         """
         if time in self.checkins:
             if status is not None:
@@ -316,12 +435,16 @@ class Node(object):
         else:
             self.checkins[time] = {'status': status, 'speed': speed}
 
-        if status is None:
-            status = 'none'
-        if status in self.status_checkins:
-            self.status_checkins[status] += 1
-        else:
-            self.status_checkins[status] = 1
+    @property
+    def status_checkins(self):
+        """Return a frequency count of each status over the time samples."""
+        result = {'none': 0}
+        for values in self.checkins.values():
+            status = values['status']
+            if status is None:
+                status = 'none'
+            result[status] = result.get(status, 0) + 1
+        return result
 
     @property
     def is_alerting(self):
@@ -358,6 +481,44 @@ class Node(object):
     def total_upload(self):
         return self.get_total_traffic()[1]
 
+    def get_neighbors(self):
+        """Return a list of (node ID, link details) for each neighbor."""
+        result = []
+        if not self.neighbors:
+            return result
+        if isinstance(self.neighbors, dict):
+            items = self.neighbors.iteritems()
+        else:
+            items = ((x, x) for x in self.neighbors)
+        seen = set()
+        for key, value in items:
+            nodeid = get_node_ref(key)
+            if nodeid is None or nodeid in seen:
+                continue
+            seen.add(nodeid)
+            if not isinstance(value, dict):
+                value = dict()
+            result.append((nodeid, value))
+        return result
+
+    def get_gateway_path(self):
+        """Return the list of node IDs on the path to this node's gateway."""
+        if not self.gateway_path:
+            return []
+        path = [get_node_ref(x) for x in self.gateway_path]
+        return [x for x in path if x is not None]
+
+    def get_gateway(self):
+        """Return the node ID of the gateway this node uses, or None."""
+        if self.is_gateway:
+            return self.id
+        gateway = get_node_ref(self.selected_gateway)
+        if gateway is None:
+            path = self.get_gateway_path()
+            if path:
+                gateway = path[-1]
+        return gateway
+
 
 class Client(object):
     def __init__(
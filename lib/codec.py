@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/codec.py
+
+JSON codec module for cloudscraper.
+
+Every API response is decoded from JSON, and the nested fields of every node
+and client are encoded back to JSON as they are stored.  The codec uses the
+fastest JSON library available, trying ujson, then simplejson, and otherwise
+the standard json module.
+
+Responses are decoded straight from the raw body, with no intermediate copy
+as text.  When encoding, None and empty containers, which make up many of the
+nested node fields, are returned without calling the library at all.  All
+libraries encode compactly, so the output is the same whichever is used.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+
+LIBRARIES = [
+        ('ujson', ujson),
+        ('simplejson', simplejson),
+        ('json', json),
+        ]
+
+CONSTANTS = {
+        type(None): 'null',
+        dict: '{}',
+        list: '[]',
+        }
+
+
+def get_libraries():
+    """Return the names of the JSON libraries which are installed."""
+    return [name for name, module in LIBRARIES if module is not None]
+
+
+class Codec(object):
+    """Encodes and decodes JSON using one of the available libraries.
+
+    If no library name is given, the first available one is used.
+    """
+    def __init__(self, name=None):
+        available = dict(
+                (k, v) for k, v in LIBRARIES if v is not None)
+        if name is None:
+            name = get_libraries()[0]
+        if name not in available:
+            raise ValueError("JSON library {} is not available.".format(name))
+        self.name = name
+        module = available[name]
+        self.loads = module.loads
+        if name == 'ujson':
+            self.encode = lambda x: module.dumps(
+                    x, escape_forward_slashes=False)
+        else:
+            # A single encoder instance avoids constructing a new one on
+            # every call, as dumps() does for any non-default arguments.
+            self.encode = module.JSONEncoder(separators=(',', ':')).encode
+
+    def __repr__(self):
+        return 'Codec {}'.format(self.name)
+
+    def dumps(self, value):
+        """Return a value encoded as JSON."""
+        if not value:
+            result = CONSTANTS.get(type(value))
+            if result is not None:
+                return result
+        return self.encode(value)
+
+
+codec = Codec()
+loads = codec.loads
+dumps = codec.dumps
@@ -18,6 +18,20 @@ class Config(RawConfigParser):
         RawConfigParser.__init__(self)
         self.read(config_file)
 
+    def get_accounts(self):
+        """Return the names of the configured CloudTrax API accounts.
+
+        The account in the plain [api] section is named None, and accounts in
+        [api:<name>] sections by their name.
+        """
+        accounts = []
+        for section in self.sections():
+            if section == 'api':
+                accounts.append(None)
+            elif section.startswith('api:'):
+                accounts.append(section.split(':', 1)[1].strip())
+        return accounts
+
     def get_db(self):
         """Return database config."""
         return dict(self.items('database'))
@@ -25,3 +39,84 @@ class Config(RawConfigParser):
     def get_email(self):
         """Return email config"""
         return dict(self.items('email'))
+
+    def get_report(self):
+        """Return report config, or an empty dict if absent."""
+        if not self.has_section('report'):
+            return dict()
+        return dict(self.items('report'))
+
+    def get_report_recipients(self):
+        """Return per-network report recipients, keyed by network ID.
+
+        Recipients are given by the 'to' option of sections named
+        [report:<network id>].  Networks without one are reported to the
+        [email] recipients.
+        """
+        result = dict()
+        for section in self.sections():
+            if not section.startswith('report:'):
+                continue
+            if self.has_option(section, 'to'):
+                network = int(section.split(':', 1)[1])
+                result[network] = self.get(section, 'to')
+        return result
+
+    def get_export(self):
+        """Return export config, or an empty dict if absent."""
+        if not self.has_section('export'):
+            return dict()
+        return dict(self.items('export'))
+
+    def get_events(self):
+        """Return change event config, or an empty dict if absent."""
+        if not self.has_section('events'):
+            return dict()
+        return dict(self.items('events'))
+
+    def get_schedule(self):
+        """Return polling schedule config, or an empty dict if absent."""
+        if not self.has_section('schedule'):
+            return dict()
+        return dict(self.items('schedule'))
+
+    def get_checkpoint(self):
+        """Return run checkpoint config, or an empty dict if absent."""
+        if not self.has_section('checkpoint'):
+            return dict()
+        return dict(self.items('checkpoint'))
+
+    def get_service(self):
+        """Return query service config, or an empty dict if absent."""
+        if not self.has_section('service'):
+            return dict()
+        return dict(self.items('service'))
+
+    def get_backfill(self):
+        """Return backfill config, or an empty dict if absent."""
+        if not self.has_section('backfill'):
+            return dict()
+        return dict(self.items('backfill'))
+
+    def get_default_gateway(self):
+        """Return default gateway config, or an empty dict if absent."""
+        if not self.has_section('default_gateway'):
+            return dict()
+        return dict(self.items('default_gateway'))
+
+    def get_gateways(self):
+        """Return per-gateway config overrides, keyed by gateway MAC.
+
+        Overrides are given in sections named [gateway:<mac>], and any option
+        not set in an override falls back to [default_gateway].
+        """
+        default = self.get_default_gateway()
+        result = dict()
+        for section in self.sections():
+            if not section.startswith('gateway:'):
+                continue
+            mac = section.split(':', 1)[1].strip().lower()
+            conf = dict(default)
+            conf.update(self.items(section))
+            result[mac] = conf
+        return result
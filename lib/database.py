@@ -10,10 +10,27 @@ Authors:
     Alex Ferrara <alex@receptiveit.com.au>
     Brendan Jurd <direvus@gmail.com>
 """
-from psycopg2.extensions import AsIs
-import psycopg2
+from lib.codec import dumps
+from lib.workers import run_parallel
+import datetime
 import logging
 import json
+import os
+import re
+import sqlite3
+import time
+
+try:
+    from psycopg2.extensions import AsIs
+    from psycopg2.extras import execute_values
+    from psycopg2.pool import ThreadedConnectionPool
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+
+class MigrationInProgress(Exception):
+    """The schema is being migrated by another process."""
 
 
 def get_connection(dbtype, **kwargs):
@@ -21,167 +38,905 @@ def get_connection(dbtype, **kwargs):
     if (dbtype == 'pgsql' or
             dbtype.startswith('postgres') or
             dbtype.startswith('psycopg')):
+        if psycopg2 is None:
+            raise ImportError("Database type {} requires psycopg2.".format(
+                dbtype))
         return Postgres(**kwargs)
+    if dbtype.startswith('sqlite'):
+        return SQLite(**kwargs)
     raise ValueError("Database type {} not recognised.".format(dbtype))
 
 
+def make_insert(table, columns, verb='INSERT'):
+    """Return an INSERT statement with named placeholders for SQLite."""
+    return '{} INTO {} ({}) VALUES ({});'.format(
+            verb, table, ', '.join(columns),
+            ', '.join(':' + x for x in columns))
+
+
+def to_utc_text(value):
+    """Return a naive local datetime as UTC text, as SQLite stores times."""
+    value = datetime.datetime.utcfromtimestamp(time.mktime(value.timetuple()))
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def to_sqlite_definition(definition):
+    """Translate a PostgreSQL table definition to SQLite.
+
+    SQLite has no types for timestamps, addresses or JSON, so these are all
+    stored as text, and booleans as integers.
+    """
+    for pattern, replacement in (
+            (r'\b(timestamptz|date|macaddr|inet|jsonb)\b', 'text'),
+            (r'\b(bigint|bool)\b', 'integer'),
+            (r'\bnumeric\b', 'real'),
+            (r'\bserial PRIMARY KEY', 'integer PRIMARY KEY'),
+            (r'DEFAULT now\(\)', 'DEFAULT CURRENT_TIMESTAMP'),
+            (r'DEFAULT false', 'DEFAULT 0'),
+            ):
+        definition = re.sub(pattern, replacement, definition)
+    return definition
+
+
 class Database(object):
+    # Ordered schema migrations, as (version, description, method name).  A
+    # database at a given version has had every migration up to and
+    # including it applied.  Databases created before migrations were
+    # versioned start at version 0, so each method must also be safe to run
+    # against a schema which already has its change.
+    MIGRATIONS = [
+            (1, 'create tables', 'create_tables'),
+            (2, 'add account columns', 'add_columns'),
+            (3, 'convert JSON columns to jsonb', 'convert_json_columns'),
+            (4, 'create indexes', 'create_indexes'),
+            (5, 'create client_presence table', 'create_tables'),
+            (6, 'create ingest_run table', 'create_tables'),
+            (7, 'add gateway_usage.last_reading column', 'add_columns'),
+            (8, 'add node_checkin.updated column', 'add_columns'),
+            ]
+
+    def create_schema(self):
+        """Apply any schema migrations the database has not yet had.
+
+        Migrations are applied while holding the schema lock, so that only
+        one process migrates the schema at a time.  If another process holds
+        it, raise MigrationInProgress.
+        """
+        version = self.get_schema_version()
+        latest = self.MIGRATIONS[-1][0]
+        if version > latest:
+            logging.warning(
+                    "Database schema version %s is newer than this version "
+                    "of cloudscraper (%s).", version, latest)
+            return
+        if version == latest:
+            return
+        if not self.lock_schema():
+            raise MigrationInProgress(
+                    "The database schema is being migrated by another "
+                    "process.")
+        try:
+            # Another process may have finished migrating the schema since
+            # the version was read.
+            version = self.get_schema_version()
+            for number, description, method in self.MIGRATIONS:
+                if number <= version:
+                    continue
+                logging.info("Migrating schema to version %s: %s ...",
+                        number, description)
+                getattr(self, method)()
+                self.set_schema_version(number)
+        finally:
+            self.unlock_schema()
+
+    def lock_schema(self):
+        """Try to take the schema lock, and return whether it was taken."""
+        return True
+
+    def unlock_schema(self):
+        """Release the schema lock."""
+        pass
+
+    def get_schema_version(self):
+        """Return the version of the database schema."""
+        raise NotImplementedError()
+
+    def set_schema_version(self, version):
+        """Record that the database schema has reached a version."""
+        raise NotImplementedError()
+
     def store_data(self, cloudtrax):
         """Store data from a CloudTrax instance in the database."""
         raise NotImplemented()
 
+    def get_network_params(self, net):
+        """Return a dict of column values for a Network."""
+        return {
+            'id': net.id,
+            'name': net.name,
+            'node_count': net.node_count,
+            'new_nodes': net.new_nodes,
+            'spare_nodes': net.spare_nodes,
+            'down_gateway': net.down_gateway,
+            'down_repeater': net.down_repeater,
+            'is_fcc': net.is_fcc,
+            'latitude': net.location[0],
+            'longitude': net.location[1],
+            'latest_firmware_version': net.latest_firmware_version,
+            'account': net.account,
+            }
+
+    def get_node_params(self, node):
+        """Return a dict of column values for a Node."""
+        return {
+            'id': node.id,
+            'network': node.network,
+            'name': node.name,
+            'description': node.description,
+            'role': node.role,
+            'spare': node.spare,
+            'down': node.down,
+            'mac': node.mac,
+            'ip': node.ip,
+            'lan_info': dumps(node.lan_info),
+            'anonymous_ip': node.anonymous_ip,
+            'selected_gateway': dumps(node.selected_gateway),
+            'gateway_path': dumps(node.gateway_path),
+            'channels': dumps(node.channels),
+            'ht_modes': dumps(node.ht_modes),
+            'hardware': node.hardware,
+            'flags': node.flags,
+            'latitude': node.location[0],
+            'longitude': node.location[1],
+            'mesh_version': node.mesh_version,
+            'connection_keeper_status': node.connection_keeper_status,
+            'custom_sh_approved': node.custom_sh_approved,
+            'expedite_upgrade': node.expedite_upgrade,
+            'firmware_version': node.firmware_version,
+            'neighbors': dumps(node.neighbors),
+            'load': node.load,
+            'memfree': node.memfree,
+            'upgrade_status': node.upgrade_status,
+            'last_checkin': node.last_checkin,
+            'uptime': node.uptime,
+            'traffic': dumps(node.traffic),
+            'download': node.total_download,
+            'upload': node.total_upload,
+            }
+
+    def get_client_params(self, client):
+        """Return a dict of column values for a Client."""
+        return {
+            'mac': client.mac,
+            'network': client.network,
+            'cid': client.cid,
+            'band': client.band,
+            'bitrate': dumps(client.bitrate),
+            'channel_width': client.channel_width,
+            'link': client.link,
+            'mcs': dumps(client.mcs),
+            'signal': dumps(client.signal),
+            'traffic': dumps(client.traffic),
+            'download': client.total_download,
+            'upload': client.total_upload,
+            'wifi_mode': client.wifi_mode,
+            'last_name': client.last_name,
+            'last_node': client.last_node,
+            'last_seen': client.last_seen,
+            'name': client.name,
+            'name_override': client.name_override,
+            'blocked': client.blocked,
+            'os': client.os,
+            'os_version': client.os_version,
+            }
+
+    def get_presence_rows(self, time, clients):
+        """Return client_presence rows for Clients.
+
+        A client is first seen at the time the API last saw it, or if that
+        is not known, at the given time.
+        """
+        return [
+                (client.mac.lower(), client.network, client.last_node,
+                    client.last_seen, client.last_seen or time)
+                for client in clients]
+
+    def get_client_presence(self, mac):
+        """Return the networks a client MAC address has been seen on.
+
+        Each row is (network ID, network name, last node MAC, first seen,
+        last seen), latest first.
+        """
+        raise NotImplementedError()
+
+    def get_neighbor_rows(self, time, node):
+        """Return node_neighbor rows for a Node."""
+        rows = []
+        for neighbor, link in node.get_neighbors():
+            rssi = link.get('rssi')
+            if not isinstance(rssi, int):
+                rssi = None
+            rows.append((
+                time, node.network, node.id, neighbor, rssi,
+                dumps(link)))
+        return rows
+
+    def get_traffic_rows(self, time, node):
+        """Return node_traffic rows for a Node."""
+        return [(time, node.network, node.id, ssid,
+                 values.get('bdown'), values.get('bup'))
+                for ssid, values in (node.traffic or {}).iteritems()]
+
+    def get_gateway_usage(self, period):
+        """Return gateway usage counters for a quota period.
+
+        The result is a dict of counter dicts keyed by node ID.  A gateway
+        without a counter for this period starts from zero usage, but carries
+        over the traffic totals and reading time last seen in an earlier
+        period.
+        """
+        raise NotImplementedError()
+
+    def store_gateway_usage(self, period, counters):
+        """Store (node ID, counter dict) pairs for a quota period."""
+        raise NotImplementedError()
+
+    def store_events(self, events):
+        """Append change event dicts to the event table."""
+        raise NotImplementedError()
+
+    def get_poll_schedule(self):
+        """Return the polling schedule of each scheduled network.
+
+        The result is a dict of (is due, down gateways, down repeaters) keyed
+        by network ID, where the down counts are those last stored.
+        """
+        raise NotImplementedError()
+
+    def get_change_counts(self, networks, days):
+        """Return the number of changes in each network's down counts.
+
+        The result is a dict keyed by network ID, counting the times the
+        down gateway or down repeater count changed over the last few days.
+        """
+        raise NotImplementedError()
+
+    def store_poll_schedule(self, intervals):
+        """Schedule the next poll for (network ID, minutes) pairs."""
+        raise NotImplementedError()
+
+    def get_event_rows(self, events):
+        """Return event table rows for a list of event dicts."""
+        return [(x['time'], x['type'], x['network'], x['node'], x['client'],
+                 None if x['old'] is None else unicode(x['old']),
+                 None if x['new'] is None else unicode(x['new']))
+                for x in events]
+
+    def store_checkins(self, rows):
+        """Merge (node, time, status, speed) rows into node_checkin.
+
+        Where a row already exists, a status or speed of None leaves the
+        stored value in place.  A row's 'updated' time is set when it is
+        inserted, and again whenever its status or speed changes.
+        """
+        raise NotImplementedError()
+
+    def get_backfill_progress(self):
+        """Return the set of (network ID, period) backfills completed."""
+        raise NotImplementedError()
+
+    def store_backfill_progress(self, network, period):
+        """Record that a network's history period has been backfilled."""
+        raise NotImplementedError()
+
+    def get_checkpoint(self, max_age):
+        """Return the phase reached by each network in an unfinished run.
+
+        Only checkpoints recorded within the last 'max_age' minutes are
+        returned, as a dict of network ID to phase.
+        """
+        raise NotImplementedError()
+
+    def store_checkpoint(self, networks, phase):
+        """Record that networks have reached a phase of the current run."""
+        raise NotImplementedError()
+
+    def clear_checkpoint(self):
+        """Remove the checkpoint of the current run."""
+        raise NotImplementedError()
+
+    def store_ingest_run(self, networks):
+        """Record that an ingestion run which stored networks has finished."""
+        raise NotImplementedError()
+
+    def get_latest_ingest_run(self):
+        """Return the ID of the latest finished ingestion run, or None."""
+        raise NotImplementedError()
+
+    def get_network_names(self):
+        """Return a list of (network ID, name) for all stored networks."""
+        raise NotImplementedError()
+
+    def get_network_summaries(self):
+        """Return a summary row for each stored network.
+
+        Each row is (ID, name, account, node count, spare nodes, down
+        gateways, down repeaters, latest firmware version).
+        """
+        raise NotImplementedError()
+
+    def get_node_summaries(self, network):
+        """Return a summary row for each stored node in a network.
+
+        Each row is (ID, name, MAC, role, down, spare, firmware version,
+        last checkin, uptime, download, upload).
+        """
+        raise NotImplementedError()
+
+    def get_network_traffic(self, network, start, end):
+        """Return (hour, download, upload) rows for a network.
+
+        Traffic is the network's trailing 24 hour total as at each hour.
+        """
+        raise NotImplementedError()
+
+    def get_network_availability(self, network, start, end):
+        """Return (hour, fraction of node checkins received) rows."""
+        raise NotImplementedError()
+
+    def get_top_clients(self, network, start, end, limit=10):
+        """Return (name, download, upload) for the heaviest clients."""
+        raise NotImplementedError()
+
 
 class Postgres(Database):
+    """PostgreSQL storage.
+
+    The schema version is checked on start-up with a single query.  If a
+    'schema_cache' file is configured, the version is recorded there once
+    verified, and later runs skip the check altogether while the cache
+    shows the latest version.
+
+    With more than one writer, store_data writes the networks concurrently,
+    each through a connection taken from a pool of up to 'writers'
+    connections.  The rows of each network are still written in order, so
+    that network, node and client rows exist before their log rows.
+    """
     def __init__(self, database,
             host=None, port=5432,
-            username=None, password=None, schema='public', **kwargs):
-        self.conn = psycopg2.connect(
-                host=host,
-                port=port,
-                database=database,
-                user=username,
-                password=password)
-        self.conn.autocommit = True
+            username=None, password=None, schema='public', writers=1,
+            schema_cache=None, **kwargs):
+        params = {
+                'host': host,
+                'port': port,
+                'database': database,
+                'user': username,
+                'password': password,
+                }
+        self.conn = psycopg2.connect(**params)
         self.schema = schema
-        with self.conn.cursor() as cur:
-            cur.execute('SET search_path TO {};'.format(self.schema))
+        self.schema_cache = schema_cache
+        self.schema_key = '{}:{}/{}/{}'.format(host, port, database, schema)
+        self.setup_connection(self.conn)
+        self.writers = int(writers)
+        self.pool = None
+        if self.writers > 1:
+            self.pool = ThreadedConnectionPool(1, self.writers, **params)
         self.create_schema()
 
+    def setup_connection(self, conn):
+        """Prepare a new connection for use."""
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute('SET search_path TO {};'.format(self.schema))
+
     def store_data(self, cloudtrax):
         """Store data from a CloudTrax instance in the database."""
         with self.conn.cursor() as cur:
-            for net in cloudtrax.get_networks():
-                logging.info("Storing data for %r", net)
-                params = {
-                    'id': net.id,
-                    'name': net.name,
-                    'node_count': net.node_count,
-                    'new_nodes': net.new_nodes,
-                    'spare_nodes': net.spare_nodes,
-                    'down_gateway': net.down_gateway,
-                    'down_repeater': net.down_repeater,
-                    'is_fcc': net.is_fcc,
-                    'latitude': net.location[0],
-                    'longitude': net.location[1],
-                    'latest_firmware_version': net.latest_firmware_version,
-                    }
-                cur.execute(self.NETWORK_UPDATE_SQL, params)
-                if cur.rowcount == 0:
-                    cur.execute(self.NETWORK_INSERT_SQL, params)
-                cur.execute(self.NETWORK_LOG_SQL, (net.id,))
-            for node in cloudtrax.get_nodes():
-                logging.info("Storing data for %r", node)
+            cur.execute('SELECT now();')
+            now = cur.fetchone()[0]
+        nodes = dict((net.id, []) for net in cloudtrax.get_networks())
+        for node in cloudtrax.get_nodes():
+            nodes.setdefault(node.network, []).append(node)
+        topology = dict()
+        if cloudtrax.topology is not None:
+            for row in cloudtrax.topology.get_rows():
+                topology.setdefault(row[0], []).append((now,) + row)
+        tasks = []
+        for netid, netnodes in nodes.iteritems():
+            tasks.append((
+                cloudtrax.networks.get(netid),
+                netnodes,
+                cloudtrax.clients.get(netid, {}).values(),
+                topology.get(netid, [])))
+
+        if self.pool is None:
+            with self.conn.cursor() as cur:
+                for task in tasks:
+                    self.store_network(cur, now, *task)
+            return
+
+        # Balance the networks across the writers by their number of nodes,
+        # largest first, so that one large network does not hold up the
+        # others.
+        batches = [[] for x in range(self.writers)]
+        sizes = [0] * self.writers
+        for task in sorted(tasks, key=lambda x: len(x[1]), reverse=True):
+            index = sizes.index(min(sizes))
+            batches[index].append(task)
+            sizes[index] += len(task[1]) + 1
+
+        def write(batch):
+            conn = self.pool.getconn()
+            try:
+                if not conn.autocommit:
+                    self.setup_connection(conn)
+                with conn.cursor() as cur:
+                    for task in batch:
+                        self.store_network(cur, now, *task)
+            finally:
+                self.pool.putconn(conn)
+        batches = [x for x in batches if x]
+        run_parallel(write, batches, len(batches))
+
+    def store_network(self, cur, now, net, nodes, clients, topology):
+        """Store a network with its nodes and clients, using a cursor."""
+        neighbors = []
+        traffic = []
+        if net is not None:
+            logging.info("Storing data for %r", net)
+            params = self.get_network_params(net)
+            cur.execute(self.NETWORK_UPDATE_SQL, params)
+            if cur.rowcount == 0:
+                cur.execute(self.NETWORK_INSERT_SQL, params)
+            cur.execute(self.NETWORK_LOG_SQL, (net.id,))
+        for node in nodes:
+            logging.info("Storing data for %r", node)
+            params = self.get_node_params(node)
+            cur.execute(self.NODE_UPDATE_SQL, params)
+            if cur.rowcount == 0:
+                cur.execute(self.NODE_INSERT_SQL, params)
+            cur.execute(self.NODE_LOG_SQL, (node.id,))
+
+            neighbors.extend(self.get_neighbor_rows(now, node))
+            traffic.extend(self.get_traffic_rows(now, node))
+
+            for sample_time, values in node.checkins.iteritems():
                 params = {
-                    'id': node.id,
-                    'network': node.network,
-                    'name': node.name,
-                    'description': node.description,
-                    'role': node.role,
-                    'spare': node.spare,
-                    'down': node.down,
-                    'mac': node.mac,
-                    'ip': node.ip,
-                    'lan_info': json.dumps(node.lan_info),
-                    'anonymous_ip': node.anonymous_ip,
-                    'selected_gateway': json.dumps(node.selected_gateway),
-                    'gateway_path': json.dumps(node.gateway_path),
-                    'channels': json.dumps(node.channels),
-                    'ht_modes': json.dumps(node.ht_modes),
-                    'hardware': node.hardware,
-                    'flags': node.flags,
-                    'latitude': node.location[0],
-                    'longitude': node.location[1],
-                    'mesh_version': node.mesh_version,
-                    'connection_keeper_status': node.connection_keeper_status,
-                    'custom_sh_approved': node.custom_sh_approved,
-                    'expedite_upgrade': node.expedite_upgrade,
-                    'firmware_version': node.firmware_version,
-                    'neighbors': json.dumps(node.neighbors),
-                    'load': node.load,
-                    'memfree': node.memfree,
-                    'upgrade_status': node.upgrade_status,
-                    'last_checkin': node.last_checkin,
-                    'uptime': node.uptime,
-                    'traffic': json.dumps(node.traffic),
-                    'download': node.total_download,
-                    'upload': node.total_upload,
+                    'node': node.id,
+                    'time': sample_time,
+                    'status': values['status'],
+                    'speed': values['speed'],
                     }
-                cur.execute(self.NODE_UPDATE_SQL, params)
+                cur.execute(self.CHECKIN_UPDATE_SQL, params)
                 if cur.rowcount == 0:
-                    cur.execute(self.NODE_INSERT_SQL, params)
-                cur.execute(self.NODE_LOG_SQL, (node.id,))
-
-                for time, values in node.checkins.iteritems():
-                    params = {
-                        'node': node.id,
-                        'time': time,
-                        'status': values['status'],
-                        'speed': values['speed'],
+                    cur.execute(self.CHECKIN_INSERT_SQL, params)
+        execute_values(cur, self.NEIGHBOR_INSERT_SQL, neighbors)
+        execute_values(cur, self.TRAFFIC_INSERT_SQL, traffic)
+        execute_values(cur, self.TOPOLOGY_INSERT_SQL, topology)
+        for client in clients:
+            logging.info("Storing data for %r", client)
+            params = self.get_client_params(client)
+            cur.execute(self.CLIENT_UPDATE_SQL, params)
+            if cur.rowcount == 0:
+                cur.execute(self.CLIENT_INSERT_SQL, params)
+            cur.execute(self.CLIENT_LOG_SQL, {
+                'mac': client.mac,
+                'network': client.network})
+        execute_values(
+                cur, self.PRESENCE_UPSERT_SQL,
+                self.get_presence_rows(now, clients))
+
+    def get_gateway_usage(self, period):
+        """Return gateway usage counters for a quota period."""
+        result = dict()
+        with self.conn.cursor() as cur:
+            cur.execute(self.GATEWAY_USAGE_SQL, (period,))
+            for row in cur:
+                (node, row_period, down, up, last_down, last_up,
+                        last_reading, alerted) = row
+                if row_period != period:
+                    down = up = 0
+                    alerted = False
+                result[node] = {
+                        'download': down,
+                        'upload': up,
+                        'last_download': last_down,
+                        'last_upload': last_up,
+                        'last_reading': last_reading,
+                        'alerted': alerted,
                         }
-                    cur.execute(self.CHECKIN_UPDATE_SQL, params)
-                    if cur.rowcount == 0:
-                        cur.execute(self.CHECKIN_INSERT_SQL, params)
-            for client in cloudtrax.get_clients():
-                logging.info("Storing data for %r", client)
-                params = {
-                    'mac': client.mac,
-                    'network': client.network,
-                    'cid': client.cid,
-                    'band': client.band,
-                    'bitrate': json.dumps(client.bitrate),
-                    'channel_width': client.channel_width,
-                    'link': client.link,
-                    'mcs': json.dumps(client.mcs),
-                    'signal': json.dumps(client.signal),
-                    'traffic': json.dumps(client.traffic),
-                    'download': client.total_download,
-                    'upload': client.total_upload,
-                    'wifi_mode': client.wifi_mode,
-                    'last_name': client.last_name,
-                    'last_node': client.last_node,
-                    'last_seen': client.last_seen,
-                    'name': client.name,
-                    'name_override': client.name_override,
-                    'blocked': client.blocked,
-                    'os': client.os,
-                    'os_version': client.os_version,
-                    }
-                cur.execute(self.CLIENT_UPDATE_SQL, params)
+        return result
+
+    def store_gateway_usage(self, period, counters):
+        """Store (node ID, counter dict) pairs for a quota period."""
+        with self.conn.cursor() as cur:
+            for node, counter in counters:
+                params = dict(counter, node=node, period=period)
+                cur.execute(self.GATEWAY_USAGE_UPDATE_SQL, params)
                 if cur.rowcount == 0:
-                    cur.execute(self.CLIENT_INSERT_SQL, params)
-                cur.execute(self.CLIENT_LOG_SQL, {
-                    'mac': client.mac,
-                    'network': client.network})
+                    cur.execute(self.GATEWAY_USAGE_INSERT_SQL, params)
 
-    def table_exists(self, table):
-        """Return whether the given table exists in the database."""
+    def store_events(self, events):
+        """Append change event dicts to the event table."""
         with self.conn.cursor() as cur:
-            cur.execute(self.CHECK_TABLE_SQL, (self.schema, table))
-            return (cur.rowcount > 0)
+            execute_values(cur, self.EVENT_INSERT_SQL,
+                    self.get_event_rows(events))
 
-    def create_schema(self):
+    def store_stats(self, stats):
+        """Store node and network statistics from a Stats instance.
+
+        An outage continued from the start of a node's history is merged
+        into the node's stored outage which reaches that far, if there is
+        one, extending its end and adding the samples since.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute('SELECT now();')
+            now = cur.fetchone()[0]
+            execute_values(cur, self.NODE_STATS_INSERT_SQL, [
+                (now,) + row for row in stats.get_node_rows()])
+            execute_values(cur, self.NETWORK_STATS_INSERT_SQL, [
+                (now,) + row for row in stats.get_network_rows()])
+            rows = list(stats.get_outage_rows())
+            for row in stats.get_continued_outage_rows():
+                cur.execute(self.OUTAGE_MERGE_SQL, dict(zip(
+                    ('network', 'node', 'started', 'ended', 'samples',
+                        'times'), row)))
+                if cur.rowcount == 0:
+                    rows.append(row[:5])
+            execute_values(cur, self.OUTAGE_UPSERT_SQL, rows)
+
+    def store_checkins(self, rows):
+        """Merge (node, time, status, speed) rows into node_checkin."""
+        with self.conn.cursor() as cur:
+            execute_values(cur, self.CHECKIN_MERGE_SQL, rows,
+                    template=self.CHECKIN_MERGE_TEMPLATE, page_size=1000)
+
+    def get_backfill_progress(self):
+        """Return the set of (network ID, period) backfills completed."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.BACKFILL_PROGRESS_SQL)
+            return set(cur.fetchall())
+
+    def store_backfill_progress(self, network, period):
+        """Record that a network's history period has been backfilled."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.BACKFILL_PROGRESS_INSERT_SQL, (network, period))
+
+    def get_checkpoint(self, max_age):
+        """Return the phase reached by each network in an unfinished run."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.CHECKPOINT_SQL, (max_age,))
+            return dict(cur.fetchall())
+
+    def store_checkpoint(self, networks, phase):
+        """Record that networks have reached a phase of the current run."""
+        with self.conn.cursor() as cur:
+            execute_values(cur, self.CHECKPOINT_UPSERT_SQL, [
+                (netid, phase) for netid in networks])
+
+    def clear_checkpoint(self):
+        """Remove the checkpoint of the current run."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.CHECKPOINT_CLEAR_SQL)
+
+    def get_poll_schedule(self):
+        """Return the polling schedule of each scheduled network."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.POLL_SCHEDULE_SQL)
+            return dict((row[0], row[1:]) for row in cur)
+
+    def get_change_counts(self, networks, days):
+        """Return the number of changes in each network's down counts."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.CHANGE_COUNTS_SQL, (networks, days))
+            return dict(cur.fetchall())
+
+    def store_poll_schedule(self, intervals):
+        """Schedule the next poll for (network ID, minutes) pairs."""
+        with self.conn.cursor() as cur:
+            for network, interval in intervals:
+                params = {'network': network, 'interval': interval}
+                cur.execute(self.POLL_SCHEDULE_UPDATE_SQL, params)
+                if cur.rowcount == 0:
+                    cur.execute(self.POLL_SCHEDULE_INSERT_SQL, params)
+
+    def store_ingest_run(self, networks):
+        """Record that an ingestion run which stored networks has finished."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.INGEST_RUN_INSERT_SQL, (networks,))
+
+    def get_latest_ingest_run(self):
+        """Return the ID of the latest finished ingestion run, or None."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.LATEST_INGEST_RUN_SQL)
+            return cur.fetchone()[0]
+
+    def get_network_names(self):
+        """Return a list of (network ID, name) for all stored networks."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.NETWORK_NAMES_SQL)
+            return cur.fetchall()
+
+    def get_network_summaries(self):
+        """Return a summary row for each stored network."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.NETWORK_SUMMARY_SQL)
+            return cur.fetchall()
+
+    def get_node_summaries(self, network):
+        """Return a summary row for each stored node in a network."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.NODE_SUMMARY_SQL, (network,))
+            return cur.fetchall()
+
+    def get_network_traffic(self, network, start, end):
+        """Return (hour, download, upload) rows for a network."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.NETWORK_TRAFFIC_SQL, (network, start, end))
+            return cur.fetchall()
+
+    def get_network_availability(self, network, start, end):
+        """Return (hour, fraction of node checkins received) rows."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.NETWORK_AVAILABILITY_SQL, (network, start, end))
+            return cur.fetchall()
+
+    def get_top_clients(self, network, start, end, limit=10):
+        """Return (name, download, upload) for the heaviest clients."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.TOP_CLIENTS_SQL, (network, start, end, limit))
+            return cur.fetchall()
+
+    def get_client_presence(self, mac):
+        """Return the networks a client MAC address has been seen on."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.CLIENT_PRESENCE_SQL, (mac,))
+            return cur.fetchall()
+
+    def get_time(self):
+        """Return the current time according to the database server."""
+        with self.conn.cursor() as cur:
+            cur.execute('SELECT now();')
+            return cur.fetchone()[0]
+
+    def iter_query(self, sql, params=None, size=10000):
+        """Generate (column names, rows) batches from a query.
+
+        The query is read through a server-side cursor, so only one batch of
+        rows is held in memory at a time.
+        """
+        with self.conn.cursor(name='iter_query', withhold=True) as cur:
+            cur.itersize = size
+            cur.execute(sql, params)
+            columns = None
+            while True:
+                rows = cur.fetchmany(size)
+                if not rows:
+                    break
+                if columns is None:
+                    columns = [x[0] for x in cur.description]
+                yield columns, rows
+
+    def lock_schema(self):
+        """Try to take the schema lock, and return whether it was taken.
+
+        The lock is a session-level advisory lock on the schema's name, so
+        it is released if this process exits without unlocking it.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(self.SCHEMA_LOCK_SQL, (
+                self.SCHEMA_LOCK_ID, self.schema))
+            return cur.fetchone()[0]
+
+    def unlock_schema(self):
+        """Release the schema lock."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.SCHEMA_UNLOCK_SQL, (
+                self.SCHEMA_LOCK_ID, self.schema))
+
+    def get_schema_version(self):
+        """Return the version of the database schema.
+
+        A version cached as the latest is trusted without querying the
+        database.
+        """
+        latest = self.MIGRATIONS[-1][0]
+        if self.read_schema_cache() == latest:
+            return latest
+        with self.conn.cursor() as cur:
+            try:
+                cur.execute(self.SCHEMA_VERSION_SQL)
+            except psycopg2.ProgrammingError:
+                return 0
+            version = cur.fetchone()[0] or 0
+        if version == latest:
+            self.write_schema_cache(version)
+        return version
+
+    def set_schema_version(self, version):
+        """Record that the database schema has reached a version."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.SCHEMA_VERSION_INSERT_SQL, (version,))
+        if version == self.MIGRATIONS[-1][0]:
+            self.write_schema_cache(version)
+
+    def read_schema_cache(self):
+        """Return the cached schema version, or None if not cached."""
+        if not self.schema_cache or not os.path.exists(self.schema_cache):
+            return None
+        try:
+            with open(self.schema_cache) as fp:
+                return json.load(fp).get(self.schema_key)
+        except ValueError:
+            return None
+
+    def write_schema_cache(self, version):
+        """Record a verified schema version in the cache file, if any."""
+        if not self.schema_cache:
+            return
+        cache = dict()
+        if os.path.exists(self.schema_cache):
+            try:
+                with open(self.schema_cache) as fp:
+                    cache = json.load(fp)
+            except ValueError:
+                pass
+        cache[self.schema_key] = version
+        tmpname = self.schema_cache + '.tmp'
+        with open(tmpname, 'w') as fp:
+            json.dump(cache, fp)
+        os.rename(tmpname, self.schema_cache)
+
+    def create_tables(self):
         """Create missing tables in the database schema."""
-        for table, definition in self.TABLES:
-            if not self.table_exists(table):
+        with self.conn.cursor() as cur:
+            cur.execute(self.TABLES_SQL, (self.schema,))
+            existing = set(x[0] for x in cur.fetchall())
+            for table, definition in self.TABLES:
+                if table in existing:
+                    continue
                 logging.info("Table '%s' is absent, creating it ...", table)
-                with self.conn.cursor() as cur:
-                    cur.execute("CREATE TABLE {} ({});".format(
-                        table, definition))
+                cur.execute("CREATE TABLE {} ({});".format(table, definition))
+
+    def add_columns(self):
+        """Add missing columns to tables created by earlier versions."""
+        with self.conn.cursor() as cur:
+            cur.execute(self.COLUMNS_SQL, (
+                self.schema, list(set(x[0] for x in self.ADDED_COLUMNS))))
+            existing = set(cur.fetchall())
+            for table, column, definition in self.ADDED_COLUMNS:
+                if (table, column) not in existing:
+                    logging.info("Adding column %s.%s ...", table, column)
+                    cur.execute('ALTER TABLE {} ADD COLUMN {} {};'.format(
+                        table, column, definition))
+
+    def convert_json_columns(self, batch_size=10000):
+        """Convert JSON columns which are still of type text to jsonb.
+
+        Changing the type of a column in place rewrites the whole table
+        under an exclusive lock, so the log tables would be locked for as
+        long as the rewrite takes.  Instead, each table is converted
+        online:
 
-    CHECK_TABLE_SQL = (
+          1. a jsonb column is added alongside each text column, with a
+             trigger to fill it in from rows as they are written;
+          2. the existing rows are filled in, a batch at a time;
+          3. in one short transaction, the text columns are dropped and the
+             jsonb columns renamed to take their place.
+
+        Tables are converted in the order of TABLES, so that each log table
+        follows the table it copies its rows from.  A conversion which is
+        interrupted picks up where it left off when run again.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(self.TEXT_COLUMNS_SQL, (
+                self.schema, self.JSON_COLUMNS.keys()))
+            text_columns = dict()
+            for table, column in cur.fetchall():
+                if column in self.JSON_COLUMNS[table]:
+                    text_columns.setdefault(table, []).append(column)
+            for table, definition in self.TABLES:
+                if table in text_columns:
+                    self.convert_table(
+                            cur, table, sorted(text_columns[table]),
+                            batch_size)
+
+    def convert_table(self, cur, table, columns, batch_size):
+        """Convert text columns of a table to jsonb without locking it."""
+        logging.info("Converting %s.%s to jsonb ...",
+                table, ', '.join(columns))
+        func = '{}_to_jsonb'.format(table)
+        for column in columns:
+            cur.execute(
+                    'ALTER TABLE {} ADD COLUMN IF NOT EXISTS {}_jsonb '
+                    'jsonb;'.format(table, column))
+        cur.execute(
+                'CREATE OR REPLACE FUNCTION {}() RETURNS trigger AS $$ '
+                'BEGIN {} RETURN NEW; END; '
+                '$$ LANGUAGE plpgsql;'.format(func, ' '.join(
+                    'NEW.{0}_jsonb := NEW.{0}::jsonb;'.format(x)
+                    for x in columns)))
+        cur.execute('DROP TRIGGER IF EXISTS {0} ON {1};'.format(func, table))
+        cur.execute(
+                'CREATE TRIGGER {0} BEFORE INSERT OR UPDATE ON {1} '
+                'FOR EACH ROW EXECUTE PROCEDURE {0}();'.format(func, table))
+
+        # Every row written since the trigger was created is already
+        # converted, so only the rows before it need filling in.
+        pending = ' OR '.join(
+                '({0} IS NOT NULL AND {0}_jsonb IS NULL)'.format(x)
+                for x in columns)
+        update = 'UPDATE {} SET {} WHERE ctid = ANY(%s::tid[]);'.format(
+                table, ', '.join(
+                    '{0}_jsonb = {0}::jsonb'.format(x) for x in columns))
+        count = 0
+        for names, rows in self.iter_query(
+                'SELECT ctid FROM {} WHERE {};'.format(table, pending),
+                size=batch_size):
+            cur.execute(update, ([x[0] for x in rows],))
+            count += len(rows)
+            logging.info("Converted %s rows of %s", count, table)
+
+        cur.execute('BEGIN;')
+        try:
+            cur.execute('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE;'.format(table))
+            cur.execute('DROP TRIGGER {0} ON {1};'.format(func, table))
+            cur.execute('DROP FUNCTION {}();'.format(func))
+            cur.execute('ALTER TABLE {} {};'.format(table, ', '.join(
+                'DROP COLUMN {}'.format(x) for x in columns)))
+            for column in columns:
+                cur.execute(
+                        'ALTER TABLE {0} RENAME COLUMN {1}_jsonb '
+                        'TO {1};'.format(table, column))
+            cur.execute('COMMIT;')
+        except Exception:
+            cur.execute('ROLLBACK;')
+            raise
+
+    def create_indexes(self):
+        """Create missing indexes, without blocking writes to the tables."""
+        with self.conn.cursor() as cur:
+            for name, definition in self.INDEXES:
+                cur.execute(
+                        'CREATE INDEX CONCURRENTLY IF NOT EXISTS {} '
+                        'ON {};'.format(name, definition))
+
+    SCHEMA_VERSION_SQL = 'SELECT max(version) FROM schema_version;'
+    # Advisory locks are shared by the whole database, so the schema lock is
+    # keyed on this class ID and the name of the schema.
+    SCHEMA_LOCK_ID = 4717
+    SCHEMA_LOCK_SQL = 'SELECT pg_try_advisory_lock(%s, hashtext(%s));'
+    SCHEMA_UNLOCK_SQL = 'SELECT pg_advisory_unlock(%s, hashtext(%s));'
+    SCHEMA_VERSION_INSERT_SQL = (
+            'INSERT INTO schema_version (version) VALUES (%s);')
+
+    TABLES_SQL = (
             'SELECT table_name '
             'FROM information_schema.tables '
-            'WHERE table_schema = %s AND table_name = %s;')
+            'WHERE table_schema = %s;')
+
+    COLUMNS_SQL = (
+            'SELECT table_name, column_name '
+            'FROM information_schema.columns '
+            'WHERE table_schema = %s '
+            '    AND table_name = ANY(%s);')
+    TEXT_COLUMNS_SQL = (
+            'SELECT table_name, column_name '
+            'FROM information_schema.columns '
+            'WHERE table_schema = %s '
+            '    AND table_name = ANY(%s) '
+            "    AND data_type = 'text';")
 
     NETWORK_LOG_SQL = (
             'INSERT INTO network_log ('
             '    id, name, node_count, new_nodes, spare_nodes, '
             '    down_gateway, down_repeater, is_fcc, '
-            '    latitude, longitude, latest_firmware_version) '
+            '    latitude, longitude, latest_firmware_version, account) '
             'SELECT '
             '    id, name, node_count, new_nodes, spare_nodes, '
             '    down_gateway, down_repeater, is_fcc, '
-            '    latitude, longitude, latest_firmware_version '
+            '    latitude, longitude, latest_firmware_version, account '
             'FROM network '
             'WHERE id = %s;')
     NETWORK_UPDATE_SQL = (
@@ -196,18 +951,19 @@ class Postgres(Database):
             '    is_fcc = %(is_fcc)s, '
             '    latitude = %(latitude)s, '
             '    longitude = %(longitude)s, '
-            '    latest_firmware_version = %(latest_firmware_version)s '
+            '    latest_firmware_version = %(latest_firmware_version)s, '
+            '    account = %(account)s '
             'WHERE id = %(id)s;')
     NETWORK_INSERT_SQL = (
             'INSERT INTO network ('
             '    id, name, node_count, new_nodes, spare_nodes, '
             '    down_gateway, down_repeater, is_fcc, '
-            '    latitude, longitude, latest_firmware_version) '
+            '    latitude, longitude, latest_firmware_version, account) '
             'VALUES ('
             '    %(id)s, %(name)s, %(node_count)s, %(new_nodes)s, '
             '    %(spare_nodes)s, %(down_gateway)s, %(down_repeater)s, '
             '    %(is_fcc)s, %(latitude)s, %(longitude)s, '
-            '    %(latest_firmware_version)s);')
+            '    %(latest_firmware_version)s, %(account)s);')
 
     NODE_LOG_SQL = (
             'INSERT INTO node_log ('
@@ -335,13 +1091,220 @@ class Postgres(Database):
 
     CHECKIN_UPDATE_SQL = (
             'UPDATE node_checkin '
-            'SET status = %(status)s, speed = %(speed)s '
+            'SET '
+            '    status = %(status)s, '
+            '    speed = %(speed)s, '
+            '    updated = CASE '
+            '        WHEN status IS DISTINCT FROM %(status)s '
+            '            OR speed IS DISTINCT FROM %(speed)s '
+            '        THEN now() ELSE updated END '
             'WHERE node = %(node)s AND time = %(time)s;')
     CHECKIN_INSERT_SQL = (
-            'INSERT INTO node_checkin (node, time, status, speed) '
-            'VALUES (%(node)s, %(time)s, %(status)s, %(speed)s);')
+            'INSERT INTO node_checkin (node, time, status, speed, updated) '
+            'VALUES (%(node)s, %(time)s, %(status)s, %(speed)s, now());')
+    CHECKIN_MERGE_SQL = (
+            'INSERT INTO node_checkin (node, time, status, speed, updated) '
+            'VALUES %s '
+            'ON CONFLICT (node, time) DO UPDATE '
+            'SET '
+            '    status = coalesce(EXCLUDED.status, node_checkin.status), '
+            '    speed = coalesce(EXCLUDED.speed, node_checkin.speed), '
+            '    updated = EXCLUDED.updated '
+            'WHERE (EXCLUDED.status IS NOT NULL '
+            '        AND EXCLUDED.status IS DISTINCT FROM node_checkin.status) '
+            '    OR (EXCLUDED.speed IS NOT NULL '
+            '        AND EXCLUDED.speed IS DISTINCT FROM node_checkin.speed);')
+    CHECKIN_MERGE_TEMPLATE = '(%s, %s, %s, %s, now())'
+
+    CHECKPOINT_SQL = (
+            'SELECT network, phase FROM run_checkpoint '
+            'WHERE time > now() - %s * interval \'1 minute\';')
+    CHECKPOINT_UPSERT_SQL = (
+            'INSERT INTO run_checkpoint (network, phase) '
+            'VALUES %s '
+            'ON CONFLICT (network) DO UPDATE '
+            'SET phase = EXCLUDED.phase, time = now();')
+    CHECKPOINT_CLEAR_SQL = 'DELETE FROM run_checkpoint;'
+
+    BACKFILL_PROGRESS_SQL = (
+            'SELECT network, period FROM backfill_progress;')
+    BACKFILL_PROGRESS_INSERT_SQL = (
+            'INSERT INTO backfill_progress (network, period) '
+            'VALUES (%s, %s) '
+            'ON CONFLICT DO NOTHING;')
+
+    GATEWAY_USAGE_SQL = (
+            'SELECT DISTINCT ON (node) '
+            '    node, period, download, upload, '
+            '    last_download, last_upload, last_reading, alerted '
+            'FROM gateway_usage '
+            'WHERE period <= %s '
+            'ORDER BY node, period DESC;')
+    GATEWAY_USAGE_UPDATE_SQL = (
+            'UPDATE gateway_usage '
+            'SET '
+            '    download = %(download)s, '
+            '    upload = %(upload)s, '
+            '    last_download = %(last_download)s, '
+            '    last_upload = %(last_upload)s, '
+            '    last_reading = %(last_reading)s, '
+            '    alerted = %(alerted)s, '
+            '    updated = now() '
+            'WHERE node = %(node)s AND period = %(period)s;')
+    GATEWAY_USAGE_INSERT_SQL = (
+            'INSERT INTO gateway_usage ('
+            '    node, period, download, upload, '
+            '    last_download, last_upload, last_reading, alerted) '
+            'VALUES ('
+            '    %(node)s, %(period)s, %(download)s, %(upload)s, '
+            '    %(last_download)s, %(last_upload)s, %(last_reading)s, '
+            '    %(alerted)s);')
+
+    POLL_SCHEDULE_SQL = (
+            'SELECT s.network, s.next_poll <= now(), '
+            '    n.down_gateway, n.down_repeater '
+            'FROM network_schedule s '
+            '    LEFT JOIN network n ON n.id = s.network;')
+    CHANGE_COUNTS_SQL = (
+            'SELECT id, count(*) '
+            'FROM ('
+            '    SELECT id, row_number() OVER w AS seq, '
+            '        down_gateway IS DISTINCT FROM lag(down_gateway) OVER w '
+            '        OR down_repeater IS DISTINCT FROM '
+            '            lag(down_repeater) OVER w AS changed '
+            '    FROM network_log '
+            '    WHERE id = ANY(%s) '
+            "        AND time >= now() - %s * interval '1 day' "
+            '    WINDOW w AS (PARTITION BY id ORDER BY time)) AS t '
+            'WHERE changed AND seq > 1 '
+            'GROUP BY id;')
+    POLL_SCHEDULE_UPDATE_SQL = (
+            'UPDATE network_schedule '
+            'SET '
+            '    last_polled = now(), '
+            '    poll_interval = %(interval)s, '
+            "    next_poll = now() + %(interval)s * interval '1 minute' "
+            'WHERE network = %(network)s;')
+    POLL_SCHEDULE_INSERT_SQL = (
+            'INSERT INTO network_schedule ('
+            '    network, last_polled, poll_interval, next_poll) '
+            'VALUES ('
+            '    %(network)s, now(), %(interval)s, '
+            "    now() + %(interval)s * interval '1 minute');")
+
+    NETWORK_NAMES_SQL = (
+            'SELECT id, name '
+            'FROM network '
+            'ORDER BY name, id;')
+    NETWORK_SUMMARY_SQL = (
+            'SELECT id, name, account, node_count, spare_nodes, '
+            '    down_gateway, down_repeater, latest_firmware_version '
+            'FROM network '
+            'ORDER BY name, id;')
+    NODE_SUMMARY_SQL = (
+            'SELECT id, name, mac::text, role, down, spare, '
+            '    firmware_version, last_checkin, uptime, download, upload '
+            'FROM node '
+            'WHERE network = %s '
+            'ORDER BY name, id;')
+    INGEST_RUN_INSERT_SQL = (
+            'INSERT INTO ingest_run (networks) VALUES (%s);')
+    LATEST_INGEST_RUN_SQL = 'SELECT max(id) FROM ingest_run;'
+    NETWORK_TRAFFIC_SQL = (
+            'SELECT hour, '
+            '    coalesce(sum(download), 0)::bigint, '
+            '    coalesce(sum(upload), 0)::bigint '
+            'FROM ('
+            "    SELECT date_trunc('hour', time) AS hour, id, "
+            '        max(download) AS download, max(upload) AS upload '
+            '    FROM node_log '
+            '    WHERE network = %s AND time >= %s AND time < %s '
+            '    GROUP BY 1, 2) AS nodes '
+            'GROUP BY hour '
+            'ORDER BY hour;')
+    NETWORK_AVAILABILITY_SQL = (
+            "SELECT date_trunc('hour', c.time) AS hour, "
+            '    count(c.status)::float / count(*) '
+            'FROM node_checkin c '
+            '    JOIN node n ON n.id = c.node '
+            'WHERE n.network = %s AND c.time >= %s AND c.time < %s '
+            'GROUP BY 1 '
+            'ORDER BY 1;')
+    TOP_CLIENTS_SQL = (
+            'SELECT coalesce(name_override, name, mac::text), '
+            '    coalesce(download, 0), coalesce(upload, 0) '
+            'FROM client '
+            'WHERE network = %s AND last_seen >= %s AND last_seen < %s '
+            'ORDER BY coalesce(download, 0) + coalesce(upload, 0) DESC '
+            'LIMIT %s;')
+    CLIENT_PRESENCE_SQL = (
+            'SELECT p.network, n.name, p.last_node, p.first_seen, '
+            '    p.last_seen '
+            'FROM client_presence p '
+            '    LEFT JOIN network n ON n.id = p.network '
+            'WHERE p.mac = %s '
+            'ORDER BY p.last_seen DESC;')
+    PRESENCE_UPSERT_SQL = (
+            'INSERT INTO client_presence ('
+            '    mac, network, last_node, last_seen, first_seen) '
+            'VALUES %s '
+            'ON CONFLICT (mac, network) DO UPDATE '
+            'SET '
+            '    last_node = EXCLUDED.last_node, '
+            '    last_seen = coalesce('
+            '        EXCLUDED.last_seen, client_presence.last_seen), '
+            '    first_seen = least('
+            '        client_presence.first_seen, EXCLUDED.first_seen), '
+            '    updated = now();')
+
+    NEIGHBOR_INSERT_SQL = (
+            'INSERT INTO node_neighbor ('
+            '    time, network, node, neighbor, rssi, data) '
+            'VALUES %s;')
+    TRAFFIC_INSERT_SQL = (
+            'INSERT INTO node_traffic ('
+            '    time, network, node, ssid, download, upload) '
+            'VALUES %s;')
+    TOPOLOGY_INSERT_SQL = (
+            'INSERT INTO node_topology ('
+            '    time, network, node, gateway, hops) '
+            'VALUES %s;')
+    NODE_STATS_INSERT_SQL = (
+            'INSERT INTO node_stats ('
+            '    time, network, node, samples, available, availability, '
+            '    speed_p50, speed_p95) '
+            'VALUES %s;')
+    NETWORK_STATS_INSERT_SQL = (
+            'INSERT INTO network_stats ('
+            '    time, network, samples, available, availability, '
+            '    speed_p50, speed_p95) '
+            'VALUES %s;')
+    OUTAGE_UPSERT_SQL = (
+            'INSERT INTO node_outage (network, node, started, ended, samples) '
+            'VALUES %s '
+            'ON CONFLICT (node, started) DO UPDATE '
+            'SET ended = EXCLUDED.ended, samples = EXCLUDED.samples;')
+    OUTAGE_MERGE_SQL = (
+            'UPDATE node_outage o '
+            'SET '
+            '    ended = greatest(o.ended, %(ended)s), '
+            '    samples = o.samples + ('
+            '        SELECT count(*) '
+            '        FROM unnest(%(times)s::timestamptz[]) AS t '
+            '        WHERE t > o.ended) '
+            'WHERE o.node = %(node)s AND o.started = ('
+            '    SELECT min(started) FROM node_outage '
+            '    WHERE node = %(node)s '
+            '        AND started < %(started)s AND ended >= %(started)s);')
+    EVENT_INSERT_SQL = (
+            'INSERT INTO event ('
+            '    time, type, network, node, client, old, new) '
+            'VALUES %s;')
 
     TABLES = [
+            ('schema_version',
+                'version int NOT NULL, '
+                'applied timestamptz NOT NULL DEFAULT now()'),
             ('network',
                 'id int PRIMARY KEY, '
                 'name text, '
@@ -353,7 +1316,8 @@ class Postgres(Database):
                 'is_fcc bool, '
                 'longitude numeric, '
                 'latitude numeric, '
-                'latest_firmware_version text'),
+                'latest_firmware_version text, '
+                'account text'),
             ('network_log',
                 'time timestamptz NOT NULL DEFAULT now(), '
                 'id int NOT NULL, '
@@ -367,6 +1331,7 @@ class Postgres(Database):
                 'longitude numeric, '
                 'latitude numeric, '
                 'latest_firmware_version text, '
+                'account text, '
                 'PRIMARY KEY (time, id)'),
             ('node',
                 'id int PRIMARY KEY, '
@@ -378,12 +1343,12 @@ class Postgres(Database):
                 'down bool, '
                 'mac macaddr, '
                 'ip inet, '
-                'lan_info text, '
+                'lan_info jsonb, '
                 'anonymous_ip bool, '
-                'selected_gateway text, '
-                'gateway_path text, '
-                'channels text, '
-                'ht_modes text, '
+                'selected_gateway jsonb, '
+                'gateway_path jsonb, '
+                'channels jsonb, '
+                'ht_modes jsonb, '
                 'hardware text, '
                 'flags int, '
                 'latitude numeric, '
@@ -393,13 +1358,13 @@ class Postgres(Database):
                 'custom_sh_approved bool, '
                 'expedite_upgrade bool, '
                 'firmware_version text, '
-                'neighbors text, '
+                'neighbors jsonb, '
                 'load text, '
                 'memfree int, '
                 'upgrade_status text, '
                 'last_checkin timestamptz, '
                 'uptime text, '
-                'traffic text, '
+                'traffic jsonb, '
                 'download int, '
                 'upload int'),
             ('node_log',
@@ -413,12 +1378,12 @@ class Postgres(Database):
                 'down bool, '
                 'mac macaddr, '
                 'ip inet, '
-                'lan_info text, '
+                'lan_info jsonb, '
                 'anonymous_ip bool, '
-                'selected_gateway text, '
-                'gateway_path text, '
-                'channels text, '
-                'ht_modes text, '
+                'selected_gateway jsonb, '
+                'gateway_path jsonb, '
+                'channels jsonb, '
+                'ht_modes jsonb, '
                 'hardware text, '
                 'flags int, '
                 'latitude numeric, '
@@ -428,13 +1393,13 @@ class Postgres(Database):
                 'custom_sh_approved bool, '
                 'expedite_upgrade bool, '
                 'firmware_version text, '
-                'neighbors text, '
+                'neighbors jsonb, '
                 'load text, '
                 'memfree int, '
                 'upgrade_status text, '
                 'last_checkin timestamptz, '
                 'uptime text, '
-                'traffic text, '
+                'traffic jsonb, '
                 'download int, '
                 'upload int, '
                 'PRIMARY KEY (time, id)'),
@@ -443,12 +1408,12 @@ class Postgres(Database):
                 'network int, '
                 'cid text, '
                 'band text, '
-                'bitrate text, '
+                'bitrate jsonb, '
                 'channel_width int, '
                 'link text, '
-                'mcs text, '
-                'signal text, '
-                'traffic text, '
+                'mcs jsonb, '
+                'signal jsonb, '
+                'traffic jsonb, '
                 'download int, '
                 'upload int, '
                 'wifi_mode text, '
@@ -461,18 +1426,26 @@ class Postgres(Database):
                 'os text, '
                 'os_version text, '
                 'PRIMARY KEY (mac, network)'),
+            ('client_presence',
+                'mac macaddr NOT NULL, '
+                'network int NOT NULL, '
+                'last_node macaddr, '
+                'first_seen timestamptz NOT NULL DEFAULT now(), '
+                'last_seen timestamptz, '
+                'updated timestamptz NOT NULL DEFAULT now(), '
+                'PRIMARY KEY (mac, network)'),
             ('client_log',
                 'time timestamptz NOT NULL DEFAULT now(), '
                 'mac macaddr, '
                 'network int, '
                 'cid text, '
                 'band text, '
-                'bitrate text, '
+                'bitrate jsonb, '
                 'channel_width int, '
                 'link text, '
-                'mcs text, '
-                'signal text, '
-                'traffic text, '
+                'mcs jsonb, '
+                'signal jsonb, '
+                'traffic jsonb, '
                 'download int, '
                 'upload int, '
                 'wifi_mode text, '
@@ -490,5 +1463,602 @@ class Postgres(Database):
                 'time timestamptz NOT NULL, '
                 'status text, '
                 'speed int, '
-                'PRIMARY KEY (node, time)')
+                'updated timestamptz DEFAULT now(), '
+                'PRIMARY KEY (node, time)'),
+            ('gateway_usage',
+                'node int NOT NULL, '
+                'period date NOT NULL, '
+                'download bigint NOT NULL DEFAULT 0, '
+                'upload bigint NOT NULL DEFAULT 0, '
+                'last_download bigint NOT NULL DEFAULT 0, '
+                'last_upload bigint NOT NULL DEFAULT 0, '
+                'last_reading double precision, '
+                'alerted bool NOT NULL DEFAULT false, '
+                'updated timestamptz NOT NULL DEFAULT now(), '
+                'PRIMARY KEY (node, period)'),
+            ('node_neighbor',
+                'time timestamptz NOT NULL, '
+                'network int, '
+                'node int NOT NULL, '
+                'neighbor int NOT NULL, '
+                'rssi int, '
+                'data jsonb, '
+                'PRIMARY KEY (node, time, neighbor)'),
+            ('node_traffic',
+                'time timestamptz NOT NULL, '
+                'network int, '
+                'node int NOT NULL, '
+                'ssid text NOT NULL, '
+                'download bigint, '
+                'upload bigint, '
+                'PRIMARY KEY (node, time, ssid)'),
+            ('node_topology',
+                'time timestamptz NOT NULL, '
+                'network int, '
+                'node int NOT NULL, '
+                'gateway int, '
+                'hops int, '
+                'PRIMARY KEY (node, time)'),
+            ('node_stats',
+                'time timestamptz NOT NULL, '
+                'network int, '
+                'node int NOT NULL, '
+                'samples int NOT NULL, '
+                'available int NOT NULL, '
+                'availability real, '
+                'speed_p50 real, '
+                'speed_p95 real, '
+                'PRIMARY KEY (node, time)'),
+            ('network_stats',
+                'time timestamptz NOT NULL, '
+                'network int NOT NULL, '
+                'samples int NOT NULL, '
+                'available int NOT NULL, '
+                'availability real, '
+                'speed_p50 real, '
+                'speed_p95 real, '
+                'PRIMARY KEY (network, time)'),
+            ('node_outage',
+                'network int, '
+                'node int NOT NULL, '
+                'started timestamptz NOT NULL, '
+                'ended timestamptz NOT NULL, '
+                'samples int NOT NULL, '
+                'PRIMARY KEY (node, started)'),
+            ('event',
+                'id serial PRIMARY KEY, '
+                'time timestamptz NOT NULL, '
+                'type text NOT NULL, '
+                'network int, '
+                'node int, '
+                'client macaddr, '
+                'old text, '
+                'new text'),
+            ('network_schedule',
+                'network int PRIMARY KEY, '
+                'last_polled timestamptz, '
+                'poll_interval int, '
+                'next_poll timestamptz'),
+            ('backfill_progress',
+                'network int NOT NULL, '
+                'period text NOT NULL, '
+                'finished timestamptz NOT NULL DEFAULT now(), '
+                'PRIMARY KEY (network, period)'),
+            ('ingest_run',
+                'id serial PRIMARY KEY, '
+                'finished timestamptz NOT NULL DEFAULT now(), '
+                'networks int'),
+            ('run_checkpoint',
+                'network int PRIMARY KEY, '
+                'phase text NOT NULL, '
+                'time timestamptz NOT NULL DEFAULT now()'),
+            ]
+
+    # Columns added to tables after they were first released, which
+    # add_columns() adds to existing tables.
+    ADDED_COLUMNS = [
+            ('network', 'account', 'text'),
+            ('network_log', 'account', 'text'),
+            ('gateway_usage', 'last_reading', 'double precision'),
+            ('node_checkin', 'updated', 'timestamptz'),
+            ]
+
+    # Columns holding JSON documents from the API.  These were originally
+    # created as text, and are converted to jsonb by convert_json_columns().
+    JSON_COLUMNS = {
+            'node': (
+                'lan_info', 'selected_gateway', 'gateway_path', 'channels',
+                'ht_modes', 'neighbors', 'traffic'),
+            'client': ('bitrate', 'mcs', 'signal', 'traffic'),
+            }
+    JSON_COLUMNS['node_log'] = JSON_COLUMNS['node']
+    JSON_COLUMNS['client_log'] = JSON_COLUMNS['client']
+
+    INDEXES = [
+            ('node_network_idx', 'node (network)'),
+            ('network_log_id_idx', 'network_log (id, time)'),
+            ('node_neighbors_gin', 'node USING gin (neighbors jsonb_path_ops)'),
+            ('node_gateway_path_gin',
+                'node USING gin (gateway_path jsonb_path_ops)'),
+            ('client_traffic_gin', 'client USING gin (traffic)'),
+            ('node_neighbor_neighbor_idx', 'node_neighbor (neighbor, time)'),
+            ('node_neighbor_network_idx', 'node_neighbor (network, time)'),
+            ('node_traffic_ssid_idx', 'node_traffic (ssid, time)'),
+            ('node_traffic_network_idx', 'node_traffic (network, time)'),
+            ('node_topology_gateway_idx', 'node_topology (gateway, time)'),
+            ('node_stats_network_idx', 'node_stats (network, time)'),
+            ('node_outage_network_idx', 'node_outage (network, started)'),
+            ('event_type_idx', 'event (type, time)'),
+            ('event_network_idx', 'event (network, time)'),
+            ]
+
+
+class SQLite(Database):
+    """Embedded SQLite storage, for collectors without a database server.
+
+    The tables mirror Postgres.TABLES, and the schema version is kept in
+    the database's user_version.  The database runs in WAL mode, and
+    each call to store_data is written as a single transaction using bulk
+    executemany() statements.
+
+    All times are stored in UTC, as SQLite's own clock is.  As with
+    Postgres, query windows are given and hours are returned in local
+    time.
+    """
+    def __init__(self, database, **kwargs):
+        self.conn = sqlite3.connect(database)
+        self.conn.execute('PRAGMA journal_mode = WAL;')
+        self.conn.execute('PRAGMA synchronous = NORMAL;')
+        self.create_schema()
+
+    def get_schema_version(self):
+        """Return the version of the database schema."""
+        return self.conn.execute('PRAGMA user_version;').fetchone()[0]
+
+    def set_schema_version(self, version):
+        """Record that the database schema has reached a version."""
+        self.conn.execute('PRAGMA user_version = {:d};'.format(version))
+
+    def create_tables(self):
+        """Create missing tables in the database."""
+        with self.conn:
+            for table, definition in Postgres.TABLES:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS {} ({});'.format(
+                    table, to_sqlite_definition(definition)))
+
+    def add_columns(self):
+        """Add missing columns to tables created by earlier versions."""
+        with self.conn:
+            for table, column, definition in Postgres.ADDED_COLUMNS:
+                columns = [x[1] for x in self.conn.execute(
+                    'PRAGMA table_info({});'.format(table))]
+                if column not in columns:
+                    logging.info("Adding column %s.%s ...", table, column)
+                    self.conn.execute('ALTER TABLE {} ADD COLUMN {} {};'.format(
+                        table, column, to_sqlite_definition(definition)))
+
+    def convert_json_columns(self):
+        """Do nothing, as SQLite always stores JSON as text."""
+        pass
+
+    def create_indexes(self):
+        """Create missing indexes in the database."""
+        with self.conn:
+            for name, definition in self.INDEXES:
+                self.conn.execute(
+                        'CREATE INDEX IF NOT EXISTS {} ON {};'.format(
+                            name, definition))
+
+    def store_data(self, cloudtrax):
+        """Store data from a CloudTrax instance in the database."""
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+        networks = []
+        nodes = []
+        checkins = []
+        neighbors = []
+        traffic = []
+        clients = []
+        for net in cloudtrax.get_networks():
+            networks.append(self.get_network_params(net))
+        for node in cloudtrax.get_nodes():
+            nodes.append(self.get_node_params(node))
+            for sample_time, values in node.checkins.iteritems():
+                checkins.append((
+                    node.id, sample_time, values['status'], values['speed']))
+            neighbors.extend(self.get_neighbor_rows(now, node))
+            traffic.extend(self.get_traffic_rows(now, node))
+        for client in cloudtrax.get_clients():
+            clients.append(self.get_client_params(client))
+        presence = self.get_presence_rows(now, cloudtrax.get_clients())
+        for params in networks + nodes + clients:
+            params['time'] = now
+        logging.info("Storing %s networks, %s nodes and %s clients",
+                len(networks), len(nodes), len(clients))
+
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.executemany(self.NETWORK_UPSERT_SQL, networks)
+            cur.executemany(self.NETWORK_LOG_SQL, networks)
+            cur.executemany(self.NODE_UPSERT_SQL, nodes)
+            cur.executemany(self.NODE_LOG_SQL, nodes)
+            cur.executemany(self.CHECKIN_UPSERT_SQL, checkins)
+            cur.executemany(self.NEIGHBOR_INSERT_SQL, neighbors)
+            cur.executemany(self.TRAFFIC_INSERT_SQL, traffic)
+            if cloudtrax.topology is not None:
+                cur.executemany(self.TOPOLOGY_INSERT_SQL, [
+                    (now,) + row for row in cloudtrax.topology.get_rows()])
+            cur.executemany(self.CLIENT_UPSERT_SQL, clients)
+            cur.executemany(self.CLIENT_LOG_SQL, clients)
+            cur.executemany(self.PRESENCE_UPSERT_SQL, presence)
+
+    def get_gateway_usage(self, period):
+        """Return gateway usage counters for a quota period."""
+        result = dict()
+        period = period.isoformat()
+        for row in self.conn.execute(self.GATEWAY_USAGE_SQL, (period,)):
+            (node, row_period, down, up, last_down, last_up,
+                    last_reading, alerted) = row
+            if node in result:
+                continue
+            if row_period != period:
+                down = up = 0
+                alerted = False
+            result[node] = {
+                    'download': down,
+                    'upload': up,
+                    'last_download': last_down,
+                    'last_upload': last_up,
+                    'last_reading': last_reading,
+                    'alerted': bool(alerted),
+                    }
+        return result
+
+    def store_gateway_usage(self, period, counters):
+        """Store (node ID, counter dict) pairs for a quota period."""
+        period = period.isoformat()
+        with self.conn:
+            self.conn.executemany(self.GATEWAY_USAGE_UPSERT_SQL, [
+                dict(counter, node=node, period=period)
+                for node, counter in counters])
+
+    def store_events(self, events):
+        """Append change event dicts to the event table."""
+        with self.conn:
+            self.conn.executemany(self.EVENT_INSERT_SQL,
+                    self.get_event_rows(events))
+
+    def store_stats(self, stats):
+        """Store node and network statistics from a Stats instance.
+
+        An outage continued from the start of a node's history is merged
+        into the node's stored outage which reaches that far, if there is
+        one, extending its end and adding the samples since.
+        """
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.executemany(self.NODE_STATS_INSERT_SQL, [
+                (now,) + row for row in stats.get_node_rows()])
+            cur.executemany(self.NETWORK_STATS_INSERT_SQL, [
+                (now,) + row for row in stats.get_network_rows()])
+            rows = list(stats.get_outage_rows())
+            for row in stats.get_continued_outage_rows():
+                network, node, started, ended, samples, times = row
+                stored = cur.execute(self.OUTAGE_OPEN_SQL,
+                        (node, started, started)).fetchone()
+                if stored is None:
+                    rows.append(row[:5])
+                    continue
+                # Times are stored as the API reports them, so they compare
+                # correctly as text.
+                stored_started, stored_ended, stored_samples = stored
+                added = len([x for x in times if x > stored_ended])
+                cur.execute(self.OUTAGE_MERGE_SQL, (
+                    max(stored_ended, ended), stored_samples + added,
+                    node, stored_started))
+            cur.executemany(self.OUTAGE_UPSERT_SQL, rows)
+
+    def store_checkins(self, rows):
+        """Merge (node, time, status, speed) rows into node_checkin."""
+        with self.conn:
+            self.conn.executemany(self.CHECKIN_MERGE_SQL, rows)
+
+    def get_backfill_progress(self):
+        """Return the set of (network ID, period) backfills completed."""
+        return set(self.conn.execute(
+            Postgres.BACKFILL_PROGRESS_SQL).fetchall())
+
+    def store_backfill_progress(self, network, period):
+        """Record that a network's history period has been backfilled."""
+        with self.conn:
+            self.conn.execute(self.BACKFILL_PROGRESS_INSERT_SQL, (
+                network, period))
+
+    def get_checkpoint(self, max_age):
+        """Return the phase reached by each network in an unfinished run."""
+        return dict(self.conn.execute(self.CHECKPOINT_SQL, (
+            '-{} minutes'.format(max_age),)).fetchall())
+
+    def store_checkpoint(self, networks, phase):
+        """Record that networks have reached a phase of the current run."""
+        with self.conn:
+            self.conn.executemany(self.CHECKPOINT_UPSERT_SQL, [
+                (netid, phase) for netid in networks])
+
+    def clear_checkpoint(self):
+        """Remove the checkpoint of the current run."""
+        with self.conn:
+            self.conn.execute(Postgres.CHECKPOINT_CLEAR_SQL)
+
+    def get_poll_schedule(self):
+        """Return the polling schedule of each scheduled network."""
+        return dict(
+                (row[0], (bool(row[1]),) + tuple(row[2:]))
+                for row in self.conn.execute(self.POLL_SCHEDULE_SQL))
+
+    def get_change_counts(self, networks, days):
+        """Return the number of changes in each network's down counts."""
+        sql = self.CHANGE_COUNTS_SQL.format(', '.join('?' * len(networks)))
+        return dict(self.conn.execute(
+            sql, list(networks) + ['-{} days'.format(days)]).fetchall())
+
+    def store_poll_schedule(self, intervals):
+        """Schedule the next poll for (network ID, minutes) pairs."""
+        with self.conn:
+            self.conn.executemany(self.POLL_SCHEDULE_UPSERT_SQL, [
+                (network, interval, '+{} minutes'.format(interval))
+                for network, interval in intervals])
+
+    def store_ingest_run(self, networks):
+        """Record that an ingestion run which stored networks has finished."""
+        with self.conn:
+            self.conn.execute(self.INGEST_RUN_INSERT_SQL, (networks,))
+
+    def get_latest_ingest_run(self):
+        """Return the ID of the latest finished ingestion run, or None."""
+        return self.conn.execute(
+                Postgres.LATEST_INGEST_RUN_SQL).fetchone()[0]
+
+    def get_network_names(self):
+        """Return a list of (network ID, name) for all stored networks."""
+        return self.conn.execute(Postgres.NETWORK_NAMES_SQL).fetchall()
+
+    def get_network_summaries(self):
+        """Return a summary row for each stored network."""
+        return self.conn.execute(Postgres.NETWORK_SUMMARY_SQL).fetchall()
+
+    def get_node_summaries(self, network):
+        """Return a summary row for each stored node in a network."""
+        return self.conn.execute(
+                self.NODE_SUMMARY_SQL, (network,)).fetchall()
+
+    def get_network_traffic(self, network, start, end):
+        """Return (hour, download, upload) rows for a network."""
+        return self.query_hourly(self.NETWORK_TRAFFIC_SQL, network, start, end)
+
+    def get_network_availability(self, network, start, end):
+        """Return (hour, fraction of node checkins received) rows."""
+        return self.query_hourly(
+                self.NETWORK_AVAILABILITY_SQL, network, start, end)
+
+    def get_top_clients(self, network, start, end, limit=10):
+        """Return (name, download, upload) for the heaviest clients."""
+        return self.conn.execute(self.TOP_CLIENTS_SQL, (
+            network, to_utc_text(start), to_utc_text(end), limit)).fetchall()
+
+    def get_client_presence(self, mac):
+        """Return the networks a client MAC address has been seen on."""
+        return self.conn.execute(
+                self.CLIENT_PRESENCE_SQL, (mac.lower(),)).fetchall()
+
+    def query_hourly(self, sql, network, start, end):
+        """Return rows of an hourly query, with the hours as datetimes."""
+        rows = self.conn.execute(sql, (
+            network, to_utc_text(start), to_utc_text(end)))
+        return [(datetime.datetime.strptime(row[0], '%Y-%m-%d %H:00'),) +
+                tuple(row[1:]) for row in rows]
+
+    NETWORK_COLUMNS = (
+            'id', 'name', 'node_count', 'new_nodes', 'spare_nodes',
+            'down_gateway', 'down_repeater', 'is_fcc',
+            'latitude', 'longitude', 'latest_firmware_version', 'account')
+    NODE_COLUMNS = (
+            'id', 'network', 'name', 'description', 'role', 'spare', 'down',
+            'mac', 'ip', 'lan_info', 'anonymous_ip', 'selected_gateway',
+            'gateway_path', 'channels', 'ht_modes', 'hardware', 'flags',
+            'latitude', 'longitude', 'mesh_version',
+            'connection_keeper_status', 'custom_sh_approved',
+            'expedite_upgrade', 'firmware_version', 'neighbors', 'load',
+            'memfree', 'upgrade_status', 'last_checkin', 'uptime',
+            'traffic', 'download', 'upload')
+    CLIENT_COLUMNS = (
+            'mac', 'network', 'cid', 'band', 'bitrate', 'channel_width',
+            'link', 'mcs', 'signal', 'traffic', 'download', 'upload',
+            'wifi_mode', 'last_name', 'last_node', 'last_seen', 'name',
+            'name_override', 'blocked', 'os', 'os_version')
+    GATEWAY_USAGE_COLUMNS = (
+            'node', 'period', 'download', 'upload',
+            'last_download', 'last_upload', 'last_reading', 'alerted')
+
+    NETWORK_UPSERT_SQL = make_insert(
+            'network', NETWORK_COLUMNS, 'INSERT OR REPLACE')
+    NETWORK_LOG_SQL = make_insert(
+            'network_log', ('time',) + NETWORK_COLUMNS)
+    NODE_UPSERT_SQL = make_insert(
+            'node', NODE_COLUMNS, 'INSERT OR REPLACE')
+    NODE_LOG_SQL = make_insert(
+            'node_log', ('time',) + NODE_COLUMNS)
+    CLIENT_UPSERT_SQL = make_insert(
+            'client', CLIENT_COLUMNS, 'INSERT OR REPLACE')
+    CLIENT_LOG_SQL = make_insert(
+            'client_log', ('time',) + CLIENT_COLUMNS)
+    CHECKIN_UPSERT_SQL = (
+            'INSERT OR REPLACE INTO node_checkin (node, time, status, speed) '
+            'VALUES (?, ?, ?, ?);')
+    CHECKIN_MERGE_SQL = (
+            'INSERT INTO node_checkin (node, time, status, speed, updated) '
+            'VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP) '
+            'ON CONFLICT (node, time) DO UPDATE '
+            'SET '
+            '    status = coalesce(excluded.status, status), '
+            '    speed = coalesce(excluded.speed, speed), '
+            '    updated = excluded.updated '
+            'WHERE (excluded.status IS NOT NULL '
+            '        AND excluded.status IS NOT status) '
+            '    OR (excluded.speed IS NOT NULL '
+            '        AND excluded.speed IS NOT speed);')
+    BACKFILL_PROGRESS_INSERT_SQL = (
+            'INSERT OR IGNORE INTO backfill_progress (network, period) '
+            'VALUES (?, ?);')
+    CHECKPOINT_SQL = (
+            'SELECT network, phase FROM run_checkpoint '
+            'WHERE time > datetime(\'now\', ?);')
+    NODE_SUMMARY_SQL = (
+            'SELECT id, name, mac, role, down, spare, '
+            '    firmware_version, last_checkin, uptime, download, upload '
+            'FROM node '
+            'WHERE network = ? '
+            'ORDER BY name, id;')
+    INGEST_RUN_INSERT_SQL = 'INSERT INTO ingest_run (networks) VALUES (?);'
+    CLIENT_PRESENCE_SQL = (
+            'SELECT p.network, n.name, p.last_node, p.first_seen, '
+            '    p.last_seen '
+            'FROM client_presence p '
+            '    LEFT JOIN network n ON n.id = p.network '
+            'WHERE p.mac = ? '
+            'ORDER BY p.last_seen DESC;')
+    PRESENCE_UPSERT_SQL = (
+            'INSERT INTO client_presence ('
+            '    mac, network, last_node, last_seen, first_seen) '
+            'VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (mac, network) DO UPDATE '
+            'SET '
+            '    last_node = excluded.last_node, '
+            '    last_seen = coalesce(excluded.last_seen, last_seen), '
+            '    first_seen = CASE '
+            '        WHEN datetime(excluded.first_seen) < datetime(first_seen) '
+            '        THEN excluded.first_seen ELSE first_seen END, '
+            '    updated = CURRENT_TIMESTAMP;')
+    CHECKPOINT_UPSERT_SQL = (
+            'INSERT INTO run_checkpoint (network, phase) '
+            'VALUES (?, ?) '
+            'ON CONFLICT (network) DO UPDATE '
+            'SET phase = excluded.phase, time = CURRENT_TIMESTAMP;')
+    NEIGHBOR_INSERT_SQL = (
+            'INSERT INTO node_neighbor ('
+            '    time, network, node, neighbor, rssi, data) '
+            'VALUES (?, ?, ?, ?, ?, ?);')
+    TRAFFIC_INSERT_SQL = (
+            'INSERT INTO node_traffic ('
+            '    time, network, node, ssid, download, upload) '
+            'VALUES (?, ?, ?, ?, ?, ?);')
+    TOPOLOGY_INSERT_SQL = (
+            'INSERT INTO node_topology ('
+            '    time, network, node, gateway, hops) '
+            'VALUES (?, ?, ?, ?, ?);')
+    NODE_STATS_INSERT_SQL = (
+            'INSERT INTO node_stats ('
+            '    time, network, node, samples, available, availability, '
+            '    speed_p50, speed_p95) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?);')
+    NETWORK_STATS_INSERT_SQL = (
+            'INSERT INTO network_stats ('
+            '    time, network, samples, available, availability, '
+            '    speed_p50, speed_p95) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?);')
+    OUTAGE_UPSERT_SQL = (
+            'INSERT INTO node_outage (network, node, started, ended, samples) '
+            'VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (node, started) DO UPDATE '
+            'SET ended = excluded.ended, samples = excluded.samples;')
+    OUTAGE_OPEN_SQL = (
+            'SELECT started, ended, samples '
+            'FROM node_outage '
+            'WHERE node = ? AND started < ? AND ended >= ? '
+            'ORDER BY started '
+            'LIMIT 1;')
+    OUTAGE_MERGE_SQL = (
+            'UPDATE node_outage '
+            'SET ended = ?, samples = ? '
+            'WHERE node = ? AND started = ?;')
+    EVENT_INSERT_SQL = (
+            'INSERT INTO event ('
+            '    time, type, network, node, client, old, new) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?);')
+
+    GATEWAY_USAGE_SQL = (
+            'SELECT '
+            '    node, period, download, upload, '
+            '    last_download, last_upload, last_reading, alerted '
+            'FROM gateway_usage '
+            'WHERE period <= ? '
+            'ORDER BY node, period DESC;')
+    GATEWAY_USAGE_UPSERT_SQL = make_insert(
+            'gateway_usage', GATEWAY_USAGE_COLUMNS, 'INSERT OR REPLACE')
+
+    POLL_SCHEDULE_SQL = (
+            "SELECT s.network, s.next_poll <= datetime('now'), "
+            '    n.down_gateway, n.down_repeater '
+            'FROM network_schedule s '
+            '    LEFT JOIN network n ON n.id = s.network;')
+    CHANGE_COUNTS_SQL = (
+            'SELECT id, count(*) '
+            'FROM ('
+            '    SELECT id, row_number() OVER w AS seq, '
+            '        down_gateway IS NOT lag(down_gateway) OVER w '
+            '        OR down_repeater IS NOT '
+            '            lag(down_repeater) OVER w AS changed '
+            '    FROM network_log '
+            '    WHERE id IN ({}) '
+            "        AND time >= datetime('now', ?) "
+            '    WINDOW w AS (PARTITION BY id ORDER BY time)) AS t '
+            'WHERE changed AND seq > 1 '
+            'GROUP BY id;')
+    POLL_SCHEDULE_UPSERT_SQL = (
+            'INSERT OR REPLACE INTO network_schedule ('
+            '    network, last_polled, poll_interval, next_poll) '
+            "VALUES (?, datetime('now'), ?, datetime('now', ?));")
+
+    NETWORK_TRAFFIC_SQL = (
+            'SELECT hour, '
+            '    coalesce(sum(download), 0), coalesce(sum(upload), 0) '
+            'FROM ('
+            "    SELECT strftime('%Y-%m-%d %H:00', time, 'localtime') AS hour, "
+            '        id, '
+            '        max(download) AS download, max(upload) AS upload '
+            '    FROM node_log '
+            '    WHERE network = ? AND time >= ? AND time < ? '
+            '    GROUP BY 1, 2) AS nodes '
+            'GROUP BY hour '
+            'ORDER BY hour;')
+    NETWORK_AVAILABILITY_SQL = (
+            "SELECT strftime('%Y-%m-%d %H:00', c.time, 'localtime') AS hour, "
+            '    CAST(count(c.status) AS real) / count(*) '
+            'FROM node_checkin c '
+            '    JOIN node n ON n.id = c.node '
+            'WHERE n.network = ? '
+            '    AND datetime(c.time) >= ? AND datetime(c.time) < ? '
+            'GROUP BY 1 '
+            'ORDER BY 1;')
+    TOP_CLIENTS_SQL = (
+            'SELECT coalesce(name_override, name, mac), '
+            '    coalesce(download, 0), coalesce(upload, 0) '
+            'FROM client '
+            'WHERE network = ? '
+            '    AND datetime(last_seen) >= ? AND datetime(last_seen) < ? '
+            'ORDER BY coalesce(download, 0) + coalesce(upload, 0) DESC '
+            'LIMIT ?;')
+
+    INDEXES = [
+            ('node_network_idx', 'node (network)'),
+            ('node_neighbor_neighbor_idx', 'node_neighbor (neighbor, time)'),
+            ('node_neighbor_network_idx', 'node_neighbor (network, time)'),
+            ('node_traffic_ssid_idx', 'node_traffic (ssid, time)'),
+            ('node_traffic_network_idx', 'node_traffic (network, time)'),
+            ('node_topology_gateway_idx', 'node_topology (gateway, time)'),
+            ('node_stats_network_idx', 'node_stats (network, time)'),
+            ('node_outage_network_idx', 'node_outage (network, started)'),
+            ('event_type_idx', 'event (type, time)'),
+            ('event_network_idx', 'event (network, time)'),
+            ('network_log_id_idx', 'network_log (id, time)'),
             ]
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/events.py
+
+Change event module for cloudscraper.
+
+Each run collects a full snapshot of the networks, nodes and clients, but the
+interesting thing about a snapshot is usually how it differs from the last
+one.  The Differ keeps a compact copy of the previous snapshot in a local
+state file, compares each new collection against it, and emits typed events:
+
+    node_down, node_up          a node's down flag changed
+    firmware_changed            a node is running a different firmware
+    gateway_switched            a node is routing through a different gateway
+    client_joined, client_left  a client appeared on or vanished from a network
+
+Only the networks present in a collection are compared, so a partial run does
+not report everything it skipped as having vanished.  The very first run only
+records a snapshot, and emits no events.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+import datetime
+import json
+import logging
+import os
+
+
+def make_event(time, type, network, node=None, client=None,
+        old=None, new=None):
+    """Return an event dict."""
+    return {
+            'time': time,
+            'type': type,
+            'network': network,
+            'node': node,
+            'client': client,
+            'old': old,
+            'new': new,
+            }
+
+
+def write_events(filename, events):
+    """Append events to a JSON-lines file."""
+    with open(filename, 'a') as fp:
+        for event in events:
+            fp.write(json.dumps(event, sort_keys=True) + '\n')
+
+
+class Differ(object):
+    """Compares collected snapshots against the previous one.
+
+    The snapshot holds, for each node, its network, down flag, firmware and
+    gateway, and for each client, its network and last node.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.snapshot = None
+        if os.path.exists(self.path):
+            with open(self.path) as fp:
+                self.snapshot = json.load(fp)
+
+    def save(self):
+        """Write the current snapshot to the state file."""
+        tmpname = self.path + '.tmp'
+        with open(tmpname, 'w') as fp:
+            json.dump(self.snapshot, fp)
+        os.rename(tmpname, self.path)
+
+    @staticmethod
+    def get_node_state(node):
+        return {
+                'network': node.network,
+                'down': node.down,
+                'firmware': node.firmware_version,
+                'gateway': node.get_gateway(),
+                }
+
+    @staticmethod
+    def get_client_key(network, mac):
+        return '{}/{}'.format(network, mac)
+
+    def diff(self, cloudtrax):
+        """Return the list of events since the previous snapshot.
+
+        The snapshot is updated with the collected networks, and should be
+        saved once the events have been recorded.
+        """
+        time = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        networks = set(cloudtrax.networks.keys())
+        nodes = dict(
+                (str(node.id), self.get_node_state(node))
+                for node in cloudtrax.get_nodes())
+        clients = dict()
+        for netid, netclients in cloudtrax.clients.iteritems():
+            for mac, client in netclients.iteritems():
+                clients[self.get_client_key(netid, mac)] = {
+                        'network': netid,
+                        'node': client.last_node,
+                        }
+
+        collected = set(cloudtrax.clients.keys())
+
+        if self.snapshot is None:
+            logging.info("No previous snapshot, recording the first one.")
+            self.snapshot = {
+                    'nodes': nodes,
+                    'clients': clients,
+                    'client_networks': list(collected),
+                    }
+            return []
+
+        events = []
+        previous = self.snapshot['nodes']
+        for nodeid, state in nodes.iteritems():
+            old = previous.get(nodeid)
+            if old is None:
+                continue
+            network = state['network']
+            node = int(nodeid)
+            if state['down'] != old['down'] and state['down'] is not None:
+                events.append(make_event(
+                    time, 'node_down' if state['down'] else 'node_up',
+                    network, node))
+            if (state['firmware'] != old['firmware'] and
+                    state['firmware'] is not None):
+                events.append(make_event(
+                    time, 'firmware_changed', network, node,
+                    old=old['firmware'], new=state['firmware']))
+            if (state['gateway'] != old['gateway'] and
+                    state['gateway'] is not None and
+                    old['gateway'] is not None):
+                events.append(make_event(
+                    time, 'gateway_switched', network, node,
+                    old=old['gateway'], new=state['gateway']))
+
+        # Clients are only compared for networks whose clients were
+        # collected both last time and this time around.
+        previous = self.snapshot['clients']
+        known = set(self.snapshot['client_networks'])
+        for key, state in clients.iteritems():
+            if state['network'] in known and key not in previous:
+                events.append(make_event(
+                    time, 'client_joined', state['network'],
+                    client=key.split('/', 1)[1], new=state['node']))
+        for key, state in previous.iteritems():
+            if state['network'] in collected and key not in clients:
+                events.append(make_event(
+                    time, 'client_left', state['network'],
+                    client=key.split('/', 1)[1], old=state['node']))
+
+        # Replace the collected networks in the snapshot.
+        self.snapshot['nodes'] = dict(
+                (k, v) for k, v in self.snapshot['nodes'].iteritems()
+                if v['network'] not in networks)
+        self.snapshot['nodes'].update(nodes)
+        self.snapshot['clients'] = dict(
+                (k, v) for k, v in previous.iteritems()
+                if v['network'] not in collected)
+        self.snapshot['clients'].update(clients)
+        self.snapshot['client_networks'] = list(known | collected)
+        logging.info("Found %s change events", len(events))
+        return events
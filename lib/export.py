@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/export.py
+
+Columnar export module for cloudscraper.
+
+The log tables grow with every run, and are the target of most analytical
+queries.  This module exports them incrementally to compressed Parquet files
+partitioned by day and network, which analysts can scan without touching the
+production database:
+
+    <path>/<table>/day=<YYYY-MM-DD>/network=<id>/part-<run>-<n>.parquet
+
+Rows are read through a server-side cursor and written out in batches, so
+memory use stays flat however much there is to export.  The time of the last
+export of each table is kept in a state file alongside the exported data, and
+each export picks up from there.
+
+A node checkin sample whose status or speed changes after it was exported is
+exported again, in the partition of its sample's day, so where a sample
+appears more than once, the row with the latest 'updated' time is current.
+
+Parquet files are written with pyarrow, which must be installed to export.
+Only a PostgreSQL database can be exported.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+from decimal import Decimal
+from lib.database import Postgres
+import json
+import logging
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+STATE_FILE = 'export-state.json'
+EPOCH = '1970-01-01T00:00:00+00:00'
+
+# Queries for each exported table, selecting rows written after the previous
+# export and up to the start of this one.  Each must yield 'time' and
+# 'network' columns to partition on.  The log tables are only ever appended
+# to, with the time they were written.  A node_checkin row is for the time of
+# its sample, which may have been written much later, and may change later
+# still, so it is selected by the time it was last updated instead.  Rows
+# written before node_checkin had an updated time fall back to their sample
+# time.
+TABLES = {
+        'node_log': (
+            'SELECT * FROM node_log '
+            'WHERE time > %s::timestamptz AND time <= %s '
+            'ORDER BY time;'),
+        'client_log': (
+            'SELECT * FROM client_log '
+            'WHERE time > %s::timestamptz AND time <= %s '
+            'ORDER BY time;'),
+        'node_checkin': (
+            'SELECT c.*, n.network '
+            'FROM node_checkin c '
+            '    LEFT JOIN node n ON n.id = c.node '
+            'WHERE coalesce(c.updated, c.time) > %s::timestamptz '
+            '    AND coalesce(c.updated, c.time) <= %s '
+            'ORDER BY coalesce(c.updated, c.time);'),
+        }
+
+
+def to_column(values):
+    """Convert a column of database values to types Parquet can store."""
+    sample = next((x for x in values if x is not None), None)
+    if isinstance(sample, Decimal):
+        return [None if x is None else float(x) for x in values]
+    if isinstance(sample, (dict, list)):
+        return [None if x is None else json.dumps(x) for x in values]
+    return values
+
+
+class Exporter(object):
+    """Incremental Parquet exporter for the log tables.
+
+    Settings are taken from the [export] config: 'path', 'compression' (any
+    codec supported by pyarrow) and 'batch_size', the number of rows to
+    buffer before writing out a set of part files.
+    """
+    def __init__(self, database, path, compression='snappy', batch_size=100000):
+        if pyarrow is None:
+            raise ImportError("Exporting requires pyarrow.")
+        if not isinstance(database, Postgres):
+            raise ValueError("Exporting requires a PostgreSQL database.")
+        self.database = database
+        self.path = path
+        self.compression = compression
+        self.batch_size = int(batch_size)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.state_file = os.path.join(self.path, STATE_FILE)
+        self.state = dict()
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as fp:
+                self.state = json.load(fp)
+
+    def save_state(self):
+        """Write the last exported times to the state file."""
+        tmpname = self.state_file + '.tmp'
+        with open(tmpname, 'w') as fp:
+            json.dump(self.state, fp, indent=2, sort_keys=True)
+        os.rename(tmpname, self.state_file)
+
+    def export(self, tables=None):
+        """Export new rows from the log tables."""
+        if tables is None:
+            tables = sorted(TABLES.keys())
+        until = self.database.get_time()
+        for table in tables:
+            since = self.state.get(table, EPOCH)
+            self.export_table(table, since, until)
+            self.state[table] = until.isoformat()
+            self.save_state()
+
+    def export_table(self, table, since, until):
+        """Export rows of a table logged between two times.
+
+        Part files are written under temporary names and only renamed into
+        place once the whole table is exported, so an interrupted export
+        leaves nothing behind that the next one would duplicate.
+        """
+        logging.info("Exporting %s from %s to %s", table, since, until)
+        self.remove_partial(table)
+        run = until.strftime('%Y%m%dT%H%M%S')
+        sequence = dict()
+        written = []
+        buffers = dict()
+        buffered = 0
+        columns = None
+        count = 0
+        for columns, rows in self.database.iter_query(
+                TABLES[table], (since, until), self.batch_size):
+            timecol = columns.index('time')
+            netcol = columns.index('network')
+            for row in rows:
+                key = (row[timecol].date(), row[netcol])
+                buffers.setdefault(key, []).append(row)
+            buffered += len(rows)
+            count += len(rows)
+            if buffered >= self.batch_size:
+                written.extend(self.flush(
+                    table, run, sequence, columns, buffers))
+                buffers = dict()
+                buffered = 0
+        if buffers:
+            written.extend(self.flush(
+                    table, run, sequence, columns, buffers))
+        for tmpname in written:
+            os.rename(tmpname, tmpname[:-len('.tmp')])
+        logging.info("Exported %s rows from %s into %s files",
+                count, table, len(written))
+
+    def remove_partial(self, table):
+        """Remove part files left behind by an interrupted export."""
+        for dirpath, dirnames, filenames in os.walk(
+                os.path.join(self.path, table)):
+            for name in filenames:
+                if name.endswith('.tmp'):
+                    os.remove(os.path.join(dirpath, name))
+
+    def flush(self, table, run, sequence, columns, buffers):
+        """Write buffered rows to a part file per partition.
+
+        Return the list of files written.
+        """
+        written = []
+        for key, rows in buffers.iteritems():
+            day, network = key
+            directory = os.path.join(
+                    self.path, table,
+                    'day={:%Y-%m-%d}'.format(day),
+                    'network={}'.format(network))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            sequence[key] = sequence.get(key, -1) + 1
+            filename = os.path.join(directory, 'part-{}-{}.parquet.tmp'.format(
+                run, sequence[key]))
+            data = [to_column(list(values)) for values in zip(*rows)]
+            pyarrow.parquet.write_table(
+                    pyarrow.Table.from_arrays(
+                        [pyarrow.array(x) for x in data], names=columns),
+                    filename,
+                    compression=self.compression)
+            written.append(filename)
+        return written
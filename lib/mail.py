@@ -5,7 +5,8 @@
 Email convenience module for cloudscraper reporting.
 
 This module provides a convenience wrapper for sending multi-part email
-messages according to settings in the cloudscraper configuration.
+messages according to settings in the cloudscraper configuration, and a
+Mailer for delivering batches of messages over reused SMTP connections.
 
 © 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
 
@@ -16,12 +17,137 @@ Authors:
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
+from lib.workers import run_parallel
 import logging
 import smtplib
+import socket
+
+
+TRUE_VALUES = ('1', 'yes', 'true', 'on')
+
+
+def to_unicode(value):
+    """Return a value as text, decoding byte strings as UTF-8."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if value is None:
+        return u''
+    return unicode(value)
+
+
+def render_batch(items, get_recipients, render):
+    """Render report bodies for many recipients in one pass over the data.
+
+    Each item is offered once to get_recipients, which returns the addresses
+    interested in it.  Once all items have been bucketed by recipient,
+    render(recipient, items) is called for each recipient in turn.
+
+    Return a dict of rendered bodies keyed by recipient.
+    """
+    buckets = dict()
+    for item in items:
+        for recipient in get_recipients(item):
+            buckets.setdefault(recipient, []).append(item)
+    return dict(
+            (recipient, render(recipient, bucket))
+            for recipient, bucket in buckets.iteritems())
+
+
+class Mailer(object):
+    """SMTP delivery for batches of Email messages.
+
+    Rather than connecting and authenticating for each message, the Mailer
+    opens one connection per worker and sends its whole share of the batch
+    down it.  A connection which drops is re-established and the message
+    retried.
+
+    Settings are taken from the [email] config: 'server', 'port',
+    'username', 'password', 'starttls', 'connections' (the number of
+    parallel connections to use) and 'retries'.
+    """
+    def __init__(self, config):
+        self.smtp_server = config['server']
+        self.smtp_port = int(config.get('port', 0))
+        self.starttls = config.get('starttls', 'no').lower() in TRUE_VALUES
+        self.connections = int(config.get('connections', 1))
+        self.retries = int(config.get('retries', 1))
+
+        if 'username' in config.keys():
+            self.smtp_auth = True
+            self.smtp_username = config['username']
+            self.smtp_password = config['password']
+        else:
+            self.smtp_auth = False
+
+    def connect(self):
+        """Return a new, authenticated SMTP connection."""
+        logging.info('Connecting to SMTP server')
+        conn = smtplib.SMTP(self.smtp_server, self.smtp_port)
+        if self.starttls:
+            conn.ehlo()
+            conn.starttls()
+            conn.ehlo()
+
+        if self.smtp_auth:
+            logging.info('Authenticating to SMTP server')
+            conn.login(self.smtp_username, self.smtp_password)
+        return conn
+
+    def send(self, emails):
+        """Send a batch of Email messages, and return the number that failed."""
+        emails = list(emails)
+        if not emails:
+            return 0
+        count = max(1, min(self.connections, len(emails)))
+        shares = [emails[i::count] for i in range(count)]
+        return sum(run_parallel(self.send_share, shares, count))
+
+    def send_share(self, emails):
+        """Send Email messages over a single connection.
+
+        Return the number of messages that could not be sent.
+        """
+        conn = None
+        failures = 0
+        try:
+            for email in emails:
+                attempt = 0
+                while True:
+                    try:
+                        if conn is None:
+                            conn = self.connect()
+                        conn.sendmail(
+                                email.email_from,
+                                email.get_recipients(),
+                                email.email.as_string())
+                        break
+                    except (smtplib.SMTPServerDisconnected,
+                            socket.error) as e:
+                        logging.warning("SMTP connection lost: %s", e)
+                        conn = None
+                        attempt += 1
+                        if attempt > self.retries:
+                            logging.error("Failed to send to %s",
+                                    email.email_to)
+                            failures += 1
+                            break
+                    except smtplib.SMTPException as e:
+                        logging.error("Failed to send to %s: %s",
+                                email.email_to, e)
+                        failures += 1
+                        break
+        finally:
+            if conn is not None:
+                try:
+                    conn.quit()
+                except (smtplib.SMTPException, socket.error):
+                    pass
+        return failures
 
 
 class Email:
     def __init__(self, config):
+        self.config = config
         self.email_from = config['from']
         self.email_to = config['to']
         self.email_subject = config['subject']
@@ -52,12 +178,13 @@ class Email:
 
     def attach_text(self, text_part):
         """Attach a plain-text alternative part."""
-        part = MIMEText(text_part)
+        part = MIMEText(
+                to_unicode(text_part).encode('utf-8'), 'plain', 'utf-8')
         self.alternative.attach(part)
 
     def attach_html(self, html_part):
         """Attach a HTML alternative part."""
-        part = MIMEText(html_part, 'html')
+        part = MIMEText(to_unicode(html_part).encode('utf-8'), 'html', 'utf-8')
         self.alternative.attach(part)
 
     def attach_image(self, image):
@@ -69,14 +196,15 @@ class Email:
 
         self.email.attach(part)
 
-    def send(self):
-        logging.info('Connecting to SMTP server')
-        mailer = smtplib.SMTP(self.smtp_server)
+    def get_recipients(self):
+        """Return a list of the recipient addresses."""
+        return self.email_to.split()
 
-        if self.smtp_auth:
-            logging.info('Authenticating to SMTP server')
-            mailer.login(self.smtp_username,
-                         self.smtp_password)
+    def send(self):
+        """Send this message on its own connection.
 
-        mailer.sendmail(self.email_from, self.email_to.split(), self.email.as_string())
-        mailer.quit()
+        Raise SMTPException if the message could not be sent.
+        """
+        if Mailer(self.config).send([self]):
+            raise smtplib.SMTPException(
+                    "Failed to send to {}".format(self.email_to))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/quota.py
+
+Gateway quota module for cloudscraper.
+
+Each gateway node accrues usage into a running counter for the current quota
+period.  The counters are held in the database, so evaluating a poll costs one
+lookup and one write per gateway, no matter how much history has been logged.
+
+The API reports a node's traffic as its total over the trailing 24 hours,
+which is a sliding window rather than a counter: it goes down as well as up
+as busy hours drop out of the window.  So the usage between two polls is
+estimated from the window's average rate over the time elapsed since the last
+reading, rather than from the difference between the two totals.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+from lib.mail import Email
+import datetime
+import logging
+import time
+
+
+PERIODS = ('day', 'month')
+
+# The length in seconds of the window the API's traffic totals cover.
+WINDOW = 24 * 60 * 60
+
+
+def get_period_start(period, today=None):
+    """Return the first date of the quota period containing 'today'."""
+    if today is None:
+        today = datetime.date.today()
+    if period == 'day':
+        return today
+    if period == 'month':
+        return today.replace(day=1)
+    raise ValueError("Quota period {} not recognised.".format(period))
+
+
+def get_accrual(total, start, end):
+    """Return the usage over an interval from a trailing 24 hour total.
+
+    'start' and 'end' are in seconds since the epoch.  The usage is the
+    window's average rate over the interval, which is capped at the length
+    of the window.
+    """
+    elapsed = min(max(end - start, 0), WINDOW)
+    return int(round(total * elapsed / float(WINDOW)))
+
+
+class Quota(object):
+    """Gateway quota evaluator.
+
+    Quotas are configured in kilobytes of combined download and upload per
+    period, in the [default_gateway] section and optionally overridden for
+    individual gateways in [gateway:<mac>] sections.  Gateways which exceed
+    their quota are added to the CloudTrax 'alerting' list and queued for an
+    email notification, at most once per period.
+    """
+    def __init__(self, config):
+        self.default = config.get_default_gateway()
+        self.gateways = config.get_gateways()
+        self.period = self.default.get('period', 'month')
+        if self.period not in PERIODS:
+            raise ValueError("Quota period {} not recognised.".format(
+                self.period))
+        self.alerts = []
+
+    def get_config(self, node):
+        """Return the quota config applying to a gateway node."""
+        mac = (node.mac or '').lower()
+        return self.gateways.get(mac, self.default)
+
+    def get_limit(self, node):
+        """Return the quota for a gateway node in bytes, or None."""
+        quota = self.get_config(node).get('quota')
+        if not quota:
+            return None
+        return int(quota) * 1024
+
+    def update(self, cloudtrax, database):
+        """Accrue gateway usage from a CloudTrax instance and check quotas.
+
+        Usage is accrued over the time since the gateway's last reading, or
+        since the start of the period if that is later.  Gateways without
+        traffic figures (e.g. when history was not collected) are left alone.
+        """
+        if not self.default and not self.gateways:
+            return
+        period = get_period_start(self.period)
+        period_start = time.mktime(period.timetuple())
+        now = time.time()
+        counters = database.get_gateway_usage(period)
+        changed = []
+        for node in cloudtrax.get_nodes():
+            if not node.is_gateway or not node.traffic:
+                continue
+            down, up = node.get_total_traffic()
+            counter = counters.get(node.id)
+            if counter is None:
+                counter = {
+                        'download': 0,
+                        'upload': 0,
+                        'last_download': 0,
+                        'last_upload': 0,
+                        'last_reading': None,
+                        'alerted': False,
+                        }
+            start = max(counter['last_reading'] or period_start, period_start)
+            counter['download'] += get_accrual(down, start, now)
+            counter['upload'] += get_accrual(up, start, now)
+            counter['last_download'] = down
+            counter['last_upload'] = up
+            counter['last_reading'] = now
+
+            limit = self.get_limit(node)
+            usage = counter['download'] + counter['upload']
+            if (limit is not None and usage > limit and
+                    not counter['alerted']):
+                logging.info("%r has exceeded its quota (%s > %s)",
+                        node, usage, limit)
+                counter['alerted'] = True
+                cloudtrax.alerting.append(node)
+                self.alerts.append((node, usage, limit))
+            changed.append((node.id, counter))
+        database.store_gateway_usage(period, changed)
+
+    def get_emails(self, email_config):
+        """Return a list of Email objects notifying the queued alerts."""
+        emails = []
+        for node, usage, limit in self.alerts:
+            conf = dict(email_config)
+            to = self.get_config(node).get('email')
+            if to:
+                conf['to'] = to
+            conf['subject'] = u'Gateway quota exceeded: {}'.format(
+                    node.name or node.mac)
+            email = Email(conf)
+            email.attach_text(
+                    u'Gateway {} ({}) on network {} has used {:.1f} MB '
+                    u'this {}, exceeding its quota of {:.1f} MB.\n'.format(
+                        node.name, node.mac, node.network,
+                        usage / 1048576.0, self.period, limit / 1048576.0))
+            emails.append(email)
+        return emails
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/report.py
+
+Reporting module for cloudscraper.
+
+This module queries the stored data for each network, renders charts of
+traffic, availability and top clients, and composes them into HTML and
+plain-text email reports.  Each network is queried and rendered once, and
+every recipient then gets a single report covering all of their networks.
+
+Rendering charts is by far the most expensive part of reporting, so rendered
+images are cached on disk, keyed by the network, the chart, the data window
+and a digest of the data itself.  A chart whose data has not changed since it
+was last rendered is read back from the cache instead of being drawn again.
+
+Charts require matplotlib.  If it is not installed, reports are sent without
+them.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+from cgi import escape
+from cStringIO import StringIO
+from lib.mail import Email, render_batch, to_unicode
+import datetime
+import hashlib
+import logging
+import os
+import time
+
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as pyplot
+except ImportError:
+    pyplot = None
+
+
+DEFAULT_CACHE = '/var/cache/cloudscraper/charts'
+MEGABYTE = 1048576.0
+
+
+def get_window(days=1, today=None):
+    """Return the (start, end) datetimes of the whole days before 'today'."""
+    if today is None:
+        today = datetime.date.today()
+    end = datetime.datetime.combine(today, datetime.time())
+    return (end - datetime.timedelta(days=days), end)
+
+
+class ChartCache(object):
+    """On-disk cache of rendered chart images."""
+    def __init__(self, path, max_age=7):
+        self.path = path
+        self.max_age = max_age
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def get_filename(self, network, chart, window, data):
+        """Return the cache filename for a chart."""
+        digest = hashlib.sha1(repr((window, data))).hexdigest()
+        return os.path.join(self.path, '{}-{}-{}.png'.format(
+                network, chart, digest))
+
+    def get(self, network, chart, window, data, render):
+        """Return the image for a chart, rendering it only on a cache miss."""
+        filename = self.get_filename(network, chart, window, data)
+        if os.path.exists(filename):
+            logging.debug("Chart cache hit for %s", filename)
+            with open(filename, 'rb') as fp:
+                return fp.read()
+        image = render(data)
+        tmpname = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmpname, 'wb') as fp:
+            fp.write(image)
+        os.rename(tmpname, filename)
+        return image
+
+    def prune(self):
+        """Remove cached images not rendered within max_age days."""
+        cutoff = time.time() - self.max_age * 86400
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            if os.path.getmtime(filename) < cutoff:
+                os.remove(filename)
+
+
+def render_figure(figure):
+    """Return a matplotlib figure as PNG data, and release it."""
+    buf = StringIO()
+    figure.savefig(buf, format='png', dpi=80, bbox_inches='tight')
+    pyplot.close(figure)
+    return buf.getvalue()
+
+
+def render_traffic(data):
+    """Render a chart of trailing 24 hour download and upload, in megabytes.
+
+    The API reports node traffic as a total over the preceding day, so each
+    hourly point is the network's 24 hour total as of that hour.
+    """
+    figure, axes = pyplot.subplots(figsize=(8, 3))
+    times = [row[0] for row in data]
+    axes.plot(times, [row[1] / MEGABYTE for row in data], label='Download')
+    axes.plot(times, [row[2] / MEGABYTE for row in data], label='Upload')
+    axes.set_ylabel('MB')
+    axes.set_title('Traffic (trailing 24 hours)')
+    axes.legend(loc='upper left')
+    figure.autofmt_xdate()
+    return render_figure(figure)
+
+
+def render_availability(data):
+    """Render a chart of hourly node availability, in percent."""
+    figure, axes = pyplot.subplots(figsize=(8, 3))
+    axes.plot([row[0] for row in data], [row[1] * 100 for row in data])
+    axes.set_ylim(0, 105)
+    axes.set_ylabel('%')
+    axes.set_title('Availability')
+    figure.autofmt_xdate()
+    return render_figure(figure)
+
+
+def render_top_clients(data):
+    """Render a bar chart of the heaviest clients, in megabytes."""
+    figure, axes = pyplot.subplots(figsize=(8, 3))
+    names = [row[0] for row in data]
+    positions = range(len(names))
+    axes.barh(positions, [(row[1] + row[2]) / MEGABYTE for row in data])
+    axes.set_yticks(positions)
+    axes.set_yticklabels(names)
+    axes.invert_yaxis()
+    axes.set_xlabel('MB')
+    axes.set_title('Top clients')
+    return render_figure(figure)
+
+
+class Report(object):
+    """Email report generator, with one report per recipient.
+
+    Settings are taken from the [report] config: 'cache' (the chart cache
+    directory), 'cache_days', 'days' (the length of the reporting window)
+    and 'top_clients'.  A network's recipients are those given in its
+    [report:<network id>] section, or else those in [email].
+    """
+    CHARTS = (
+            ('traffic', render_traffic),
+            ('availability', render_availability),
+            ('clients', render_top_clients),
+            )
+
+    def __init__(self, database, config, today=None):
+        self.database = database
+        self.email_config = config.get_email()
+        self.recipients = config.get_report_recipients()
+        conf = config.get_report()
+        self.window = get_window(int(conf.get('days', 1)), today)
+        self.top_clients = int(conf.get('top_clients', 10))
+        self.cache = None
+        if pyplot is None:
+            logging.warning("matplotlib is not available, "
+                    "reports will not include charts.")
+        else:
+            self.cache = ChartCache(
+                    conf.get('cache', DEFAULT_CACHE),
+                    int(conf.get('cache_days', 7)))
+
+    def get_data(self, network):
+        """Return a dict of chart data for a network over the window."""
+        start, end = self.window
+        return {
+                'traffic': self.database.get_network_traffic(
+                    network, start, end),
+                'availability': self.database.get_network_availability(
+                    network, start, end),
+                'clients': self.database.get_top_clients(
+                    network, start, end, self.top_clients),
+                }
+
+    def get_section(self, network, name):
+        """Return the report section for a network.
+
+        The section is a dict of the network's 'network' ID and 'name', the
+        'summary' lines, the 'clients' lines and the chart 'images'.
+        """
+        data = self.get_data(network)
+        summary = []
+        if data['traffic']:
+            hour, download, upload = data['traffic'][-1]
+            summary.extend([
+                u'Download (last 24 hours): {:.1f} MB'.format(
+                    download / MEGABYTE),
+                u'Upload (last 24 hours): {:.1f} MB'.format(
+                    upload / MEGABYTE),
+                ])
+        if data['availability']:
+            availability = sum(row[1] for row in data['availability'])
+            summary.append(u'Availability: {:.1f}%'.format(
+                100.0 * availability / len(data['availability'])))
+        clients = [
+                u'    {}: {:.1f} MB'.format(
+                    to_unicode(client), (down + up) / MEGABYTE)
+                for client, down, up in data['clients']]
+
+        images = []
+        if self.cache is not None:
+            for chart, render in self.CHARTS:
+                if not data[chart]:
+                    continue
+                images.append(self.cache.get(
+                    network, chart, self.window, data[chart], render))
+        return {
+                'network': network,
+                'name': to_unicode(name),
+                'summary': summary,
+                'clients': clients,
+                'images': images,
+                }
+
+    def get_recipients(self, section):
+        """Return the addresses to report a network section to."""
+        return self.recipients.get(
+                section['network'], self.email_config['to']).split()
+
+    def compose(self, recipient, sections):
+        """Return an Email reporting on some network sections."""
+        conf = dict(self.email_config)
+        conf['to'] = recipient
+        if len(sections) == 1:
+            about = sections[0]['name']
+        else:
+            about = u'{} networks'.format(len(sections))
+        conf['subject'] = u'{} - {}'.format(to_unicode(conf['subject']), about)
+        email = Email(conf)
+
+        title = to_unicode(self.email_config.get('title', conf['subject']))
+        start, end = self.window
+        period = u'{:%Y-%m-%d %H:%M} to {:%Y-%m-%d %H:%M}'.format(start, end)
+        lines = []
+        html = [u'<h1>{}</h1>'.format(escape(title))]
+        images = []
+        for section in sections:
+            lines.extend([
+                u'{}: {}'.format(title, section['name']), period, u''])
+            lines.extend(section['summary'])
+            lines.extend([u'', u'Top clients:'])
+            lines.extend(section['clients'])
+            lines.append(u'')
+
+            html.extend([
+                u'<h2>{}</h2>'.format(escape(section['name'])),
+                u'<p>{}</p>'.format(period),
+                u'<ul>'])
+            html.extend(u'<li>{}</li>'.format(x) for x in section['summary'])
+            html.append(u'</ul>')
+            for image in section['images']:
+                images.append(image)
+                html.append(u'<p><img src="cid:image{}"></p>'.format(
+                    len(images)))
+
+        email.attach_text(u'\n'.join(lines))
+        email.attach_html(u'\n'.join(html) + u'\n')
+        for image in images:
+            email.attach_image(image)
+        return email
+
+    def get_emails(self):
+        """Return a list of report Emails, one for each recipient."""
+        sections = []
+        for network, name in self.database.get_network_names():
+            logging.info("Composing report for network %s", network)
+            sections.append(self.get_section(network, name))
+        emails = render_batch(sections, self.get_recipients, self.compose)
+        if self.cache is not None:
+            self.cache.prune()
+        return [emails[x] for x in sorted(emails)]
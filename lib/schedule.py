@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/schedule.py
+
+Adaptive polling module for cloudscraper.
+
+Rather than collecting every network on every run, the Scheduler gives each
+network its own polling interval, based on how often its down gateway and
+down repeater counts have changed in the stored history.  Networks which are
+currently alerting are polled at the minimum interval, volatile networks
+often, and quiet networks at the maximum interval.
+
+The network list is fetched on every run regardless, and a network whose down
+counts in the list differ from those last stored is polled straight away,
+even if it is not yet due.  So cloudscraper should be run at the minimum
+interval, and it will skip the networks that do not need polling.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+import logging
+
+
+class Scheduler(object):
+    """Per-network polling scheduler.
+
+    Settings are taken from the [schedule] config: 'min_interval' and
+    'max_interval' in minutes, and 'history', the number of days of network
+    history used to measure how often each network changes.
+    """
+    def __init__(self, config, database):
+        conf = config.get_schedule()
+        self.database = database
+        self.min_interval = int(conf.get('min_interval', 5))
+        self.max_interval = int(conf.get('max_interval', 60))
+        self.history = int(conf.get('history', 7))
+
+    def get_due(self, networks):
+        """Return the Networks which are due to be polled."""
+        schedule = self.database.get_poll_schedule()
+        due = []
+        for net in networks:
+            entry = schedule.get(net.id)
+            if entry is None:
+                due.append(net)
+                continue
+            is_due, down_gateway, down_repeater = entry
+            if (is_due or
+                    down_gateway != net.down_gateway or
+                    down_repeater != net.down_repeater):
+                due.append(net)
+        logging.info("%s of %s networks are due for polling",
+                len(due), len(networks))
+        return due
+
+    def get_interval(self, net, changes):
+        """Return the polling interval in minutes for a Network.
+
+        The interval shrinks from the maximum in proportion to the number of
+        changes per day in the history.
+        """
+        if net.down_gateway or net.down_repeater:
+            return self.min_interval
+        rate = float(changes) / self.history
+        interval = int(round(self.max_interval / (1.0 + rate)))
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    def update(self, networks):
+        """Schedule the next poll of Networks which have just been polled."""
+        networks = list(networks)
+        if not networks:
+            return
+        changes = self.database.get_change_counts(
+                [net.id for net in networks], self.history)
+        self.database.store_poll_schedule([
+            (net.id, self.get_interval(net, changes.get(net.id, 0)))
+            for net in networks])
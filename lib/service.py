@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/service.py
+
+Query service module for cloudscraper.
+
+A small HTTP server which answers dashboard queries from the stored data with
+JSON documents:
+
+    /networks                       summary of every network
+    /networks/<id>                  summary of a network and its nodes
+    /networks/<id>/nodes            the nodes of a network
+    /networks/<id>/traffic          hourly traffic     (?hours=24)
+    /networks/<id>/availability     hourly availability (?hours=24)
+    /networks/<id>/clients          heaviest clients   (?hours=24&limit=10)
+    /clients/<mac>                  the networks a client has been seen on
+
+The stored data only changes when cloudscraper collects, so each result is
+cached until the next ingestion run is recorded in the database, and repeated
+requests are answered without querying the tables at all.  Each result has an
+ETag, and a request whose If-None-Match matches it gets an empty 304 reply.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from decimal import Decimal
+from urlparse import urlparse, parse_qs
+import datetime
+import hashlib
+import json
+import logging
+import re
+import time
+
+
+NETWORK_FIELDS = (
+        'id', 'name', 'account', 'node_count', 'spare_nodes',
+        'down_gateway', 'down_repeater', 'latest_firmware_version')
+NODE_FIELDS = (
+        'id', 'name', 'mac', 'role', 'down', 'spare', 'firmware_version',
+        'last_checkin', 'uptime', 'download', 'upload')
+PRESENCE_FIELDS = ('network', 'name', 'last_node', 'first_seen', 'last_seen')
+MAX_HOURS = 24 * 31
+
+
+class QueryError(Exception):
+    """A request which cannot be answered, with its HTTP status."""
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def encode_value(value):
+    """Return a JSON-serialisable form of a value from the database."""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError("{!r} is not JSON serialisable".format(value))
+
+
+def encode(result):
+    """Return a query result encoded as a JSON document."""
+    return json.dumps(result, default=encode_value, sort_keys=True)
+
+
+def to_dicts(fields, rows):
+    """Return database rows as a list of dicts."""
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def get_int(query, name, default, maximum):
+    """Return a positive integer query parameter."""
+    value = query.get(name, [default])[0]
+    try:
+        value = int(value)
+    except ValueError:
+        raise QueryError(400, "'{}' must be an integer".format(name))
+    if value < 1 or value > maximum:
+        raise QueryError(400, "'{}' must be between 1 and {}".format(
+            name, maximum))
+    return value
+
+
+def get_window(hours):
+    """Return the (start, end) of the whole hours up to the current one."""
+    end = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+    end += datetime.timedelta(hours=1)
+    return (end - datetime.timedelta(hours=hours), end)
+
+
+class QueryCache(object):
+    """Encoded query results, cleared whenever a new ingestion run finishes.
+
+    The database is asked for the latest run at most once every 'interval'
+    seconds.  If the cache grows past 'size' entries, it is emptied.
+    """
+    def __init__(self, database, interval=5, size=1000):
+        self.database = database
+        self.interval = interval
+        self.size = size
+        self.run = None
+        self.checked = 0
+        self.entries = dict()
+
+    def check(self):
+        """Clear the cache if an ingestion run has finished since."""
+        now = time.time()
+        if now - self.checked < self.interval:
+            return
+        self.checked = now
+        run = self.database.get_latest_ingest_run()
+        if run != self.run:
+            if self.entries:
+                logging.info("Ingestion run %s finished, clearing cache", run)
+            self.entries.clear()
+            self.run = run
+
+    def get(self, key, func):
+        """Return the (body, ETag) for a key, calling func on a miss."""
+        self.check()
+        entry = self.entries.get(key)
+        if entry is None:
+            body = encode(func())
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            if len(self.entries) >= self.size:
+                self.entries.clear()
+            entry = self.entries[key] = (body, etag)
+        return entry
+
+
+class Service(object):
+    """Dashboard query service over the stored data.
+
+    Settings are taken from the optional [service] config: 'host' and
+    'port' to listen on, and 'check_interval', the number of seconds between
+    checks for a new ingestion run.
+    """
+    # Each route is (path pattern, method, query parameters).  The method is
+    # called with the groups of the pattern, followed by the window of the
+    # 'hours' parameter as start and end if 'hours' is listed, and then the
+    # value of 'limit' if listed.
+    ROUTES = [
+            (r'^/networks$', 'get_networks', ()),
+            (r'^/networks/(\d+)$', 'get_network', ()),
+            (r'^/networks/(\d+)/nodes$', 'get_nodes', ()),
+            (r'^/networks/(\d+)/traffic$', 'get_traffic', ('hours',)),
+            (r'^/networks/(\d+)/availability$', 'get_availability',
+                ('hours',)),
+            (r'^/networks/(\d+)/clients$', 'get_clients', ('hours', 'limit')),
+            (r'^/clients/([0-9A-Fa-f:.-]+)$', 'get_client', ()),
+            ]
+
+    def __init__(self, database, config):
+        conf = config.get_service()
+        self.database = database
+        self.host = conf.get('host', '127.0.0.1')
+        self.port = int(conf.get('port', 8080))
+        self.cache = QueryCache(
+                database, float(conf.get('check_interval', 5)))
+        self.routes = [(re.compile(k), getattr(self, v), params)
+                for k, v, params in self.ROUTES]
+
+    def serve(self):
+        """Answer requests until interrupted."""
+        server = HTTPServer((self.host, self.port), RequestHandler)
+        server.service = self
+        logging.warning("Serving queries on http://%s:%s/",
+                self.host, self.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+
+    def handle(self, url):
+        """Return the (body, ETag) of the result for a request URL.
+
+        Raise QueryError if the request cannot be answered.
+        """
+        url = urlparse(url)
+        query = parse_qs(url.query)
+        for pattern, func, params in self.routes:
+            match = pattern.match(url.path.rstrip('/') or '/')
+            if not match:
+                continue
+            # The parameters are parsed before the cache lookup, so that
+            # bad parameters are rejected, and equivalent ones share a key.
+            args = match.groups()
+            if 'hours' in params:
+                args += get_window(get_int(query, 'hours', 24, MAX_HOURS))
+            if 'limit' in params:
+                args += (get_int(query, 'limit', 10, 1000),)
+            key = (func.__name__,) + args
+            return self.cache.get(key, lambda: func(*args))
+        raise QueryError(404, "No such resource")
+
+    def get_network_row(self, network):
+        """Return the summary of a network, or raise QueryError."""
+        for row in self.database.get_network_summaries():
+            if row[0] == network:
+                return dict(zip(NETWORK_FIELDS, row))
+        raise QueryError(404, "No such network")
+
+    def get_networks(self):
+        """Return the summary of every network."""
+        return to_dicts(NETWORK_FIELDS, self.database.get_network_summaries())
+
+    def get_network(self, network):
+        """Return the summary of a network, with counts of its nodes."""
+        result = self.get_network_row(int(network))
+        nodes = to_dicts(NODE_FIELDS,
+                self.database.get_node_summaries(int(network)))
+        result['nodes'] = len(nodes)
+        result['down_nodes'] = len([x for x in nodes if x['down']])
+        result['gateways'] = len([
+            x for x in nodes if x['role'] == 'gateway'])
+        return result
+
+    def get_nodes(self, network):
+        """Return the nodes of a network."""
+        self.get_network_row(int(network))
+        return to_dicts(NODE_FIELDS,
+                self.database.get_node_summaries(int(network)))
+
+    def get_traffic(self, network, start, end):
+        """Return the hourly traffic of a network."""
+        self.get_network_row(int(network))
+        return to_dicts(('hour', 'download', 'upload'),
+                self.database.get_network_traffic(int(network), start, end))
+
+    def get_availability(self, network, start, end):
+        """Return the hourly availability of a network."""
+        self.get_network_row(int(network))
+        return to_dicts(('hour', 'availability'),
+                self.database.get_network_availability(
+                    int(network), start, end))
+
+    def get_clients(self, network, start, end, limit):
+        """Return the heaviest clients of a network."""
+        self.get_network_row(int(network))
+        return to_dicts(('name', 'download', 'upload'),
+                self.database.get_top_clients(
+                    int(network), start, end, limit))
+
+    def get_client(self, mac):
+        """Return the networks a client has been seen on."""
+        rows = self.database.get_client_presence(mac)
+        if not rows:
+            raise QueryError(404, "No such client")
+        return {
+                'mac': mac.lower(),
+                'networks': to_dicts(PRESENCE_FIELDS, rows),
+                }
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Answers HTTP requests with the server's Service."""
+    def do_GET(self):
+        try:
+            body, etag = self.server.service.handle(self.path)
+        except QueryError as e:
+            self.send_json(e.status, encode({'error': str(e)}))
+            return
+        except Exception:
+            logging.exception("Query %s failed", self.path)
+            self.send_json(500, encode({'error': 'Internal error'}))
+            return
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_json(200, body, etag)
+
+    def send_json(self, status, body, etag=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info("%s %s", self.address_string(), format % args)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/stats.py
+
+Node statistics module for cloudscraper.
+
+The node history holds a checkin sample for each node every few minutes,
+with the node's status if it checked in during the sample, and its speed if
+it carried any traffic.  From these series, Stats computes for each node and
+each network:
+
+    availability    the fraction of samples in which the node checked in
+    speed_p50       the median speed over the samples with a speed
+    speed_p95       the 95th percentile speed
+
+and, for each node, the outages: runs of consecutive samples without a
+checkin.
+
+The history only covers the last 24 hours, so an outage which runs from the
+first sample of a node's history may have begun before it, and been stored
+by an earlier run.  These continued outages are kept apart, so that they can
+be merged into the stored outage rather than recorded again from a start
+time which moves on with every run.
+
+The samples of all the nodes are laid out in flat arrays and each statistic
+is computed across every node in a single pass, rather than node by node.
+This requires numpy; if it is not installed, no statistics are computed.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+PERCENTILES = (50, 95)
+
+
+def is_available():
+    """Return whether statistics can be computed."""
+    return numpy is not None
+
+
+def get_group_percentile(groups, values, count, percentile):
+    """Return a percentile of the values in each of 'count' groups.
+
+    'groups' and 'values' are parallel arrays, giving the group index of each
+    value.  NaN values are ignored, and groups without any values have a NaN
+    result.  Percentiles are interpolated in the same way as
+    numpy.percentile.
+    """
+    keep = ~numpy.isnan(values)
+    groups = groups[keep]
+    values = values[keep]
+    values = values[numpy.lexsort((values, groups))]
+    sizes = numpy.bincount(groups, minlength=count)
+    offsets = numpy.cumsum(sizes) - sizes
+    result = numpy.full(count, numpy.nan)
+    found = sizes > 0
+    position = offsets[found] + (sizes[found] - 1) * (percentile / 100.0)
+    lower = numpy.floor(position).astype(int)
+    upper = numpy.ceil(position).astype(int)
+    result[found] = (values[lower] +
+            (values[upper] - values[lower]) * (position - lower))
+    return result
+
+
+def get_runs(groups, flags):
+    """Return the (first, last) indexes of each run of true flags.
+
+    'groups' and 'flags' are parallel arrays, sorted by group.  A run does
+    not continue from the end of one group into the next.
+    """
+    boundary = groups[1:] != groups[:-1]
+    first = numpy.ones(len(flags), dtype=bool)
+    first[1:] = boundary | ~flags[:-1]
+    last = numpy.ones(len(flags), dtype=bool)
+    last[:-1] = boundary | ~flags[1:]
+    return zip(
+            numpy.flatnonzero(flags & first),
+            numpy.flatnonzero(flags & last))
+
+
+def to_float(value):
+    """Return a numpy float as a float, or None if it is NaN."""
+    if numpy.isnan(value):
+        return None
+    return float(value)
+
+
+class Stats(object):
+    """Availability and speed statistics for a collection of Nodes.
+
+    Where the nodes have no checkins, as when history was not collected,
+    there are no statistics.
+    """
+    def __init__(self, nodes):
+        self.node_rows = []
+        self.network_rows = []
+        self.outage_rows = []
+        self.continued_rows = []
+
+        nodes = sorted(nodes)
+        groups = []
+        times = []
+        statuses = []
+        speeds = []
+        for index, node in enumerate(nodes):
+            for time in sorted(node.checkins.keys()):
+                values = node.checkins[time]
+                groups.append(index)
+                times.append(time)
+                statuses.append(values['status'] is not None)
+                speeds.append(
+                        numpy.nan if values['speed'] is None
+                        else values['speed'])
+        if not groups:
+            return
+
+        groups = numpy.array(groups)
+        available = numpy.array(statuses)
+        speeds = numpy.array(speeds, dtype=float)
+        networks = sorted(set(node.network for node in nodes))
+        netindex = dict((netid, i) for i, netid in enumerate(networks))
+        netgroups = numpy.array([
+            netindex[node.network] for node in nodes])[groups]
+
+        self.node_rows = self.get_rows(
+                [(node.network, node.id) for node in nodes],
+                groups, available, speeds)
+        self.network_rows = self.get_rows(
+                [(netid,) for netid in networks],
+                netgroups, available, speeds)
+
+        for first, last in get_runs(groups, ~available):
+            node = nodes[groups[first]]
+            row = (node.network, node.id, times[first], times[last],
+                    int(last - first + 1))
+            if first == 0 or groups[first - 1] != groups[first]:
+                self.continued_rows.append(row + (times[first:last + 1],))
+            else:
+                self.outage_rows.append(row)
+
+    @staticmethod
+    def get_rows(keys, groups, available, speeds):
+        """Return a row of statistics for each group.
+
+        Each row is the group's key followed by the number of samples, the
+        number available, the availability and the speed percentiles.
+        """
+        count = len(keys)
+        samples = numpy.bincount(groups, minlength=count)
+        checkins = numpy.bincount(groups, weights=available, minlength=count)
+        availability = checkins / numpy.maximum(samples, 1)
+        percentiles = [
+                get_group_percentile(groups, speeds, count, percentile)
+                for percentile in PERCENTILES]
+        rows = []
+        for index, key in enumerate(keys):
+            rows.append(key + (
+                int(samples[index]),
+                int(checkins[index]),
+                float(availability[index])) + tuple(
+                    to_float(x[index]) for x in percentiles))
+        return rows
+
+    def get_node_rows(self):
+        """Return node_stats rows for each node with checkins."""
+        return self.node_rows
+
+    def get_network_rows(self):
+        """Return network_stats rows for each network with checkins."""
+        return self.network_rows
+
+    def get_outage_rows(self):
+        """Return node_outage rows for each outage begun within the history.
+
+        The start and end of an outage are the times of its first and last
+        samples without a checkin.
+        """
+        return self.outage_rows
+
+    def get_continued_outage_rows(self):
+        """Return rows for outages from the start of a node's history.
+
+        Each row is a node_outage row followed by the times of the outage's
+        samples.
+        """
+        return self.continued_rows
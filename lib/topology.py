@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/topology.py
+
+Mesh topology module for cloudscraper.
+
+A Topology relates the nodes collected from CloudTrax to one another: which
+nodes can hear each other, which gateway each node routes through, and how
+many hops away from it they are.  It is built in a single pass over the nodes,
+after which the common questions about a mesh are dictionary lookups.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+from collections import Counter
+
+
+class Topology(object):
+    """Adjacency and gateway index over a set of Node objects."""
+    def __init__(self, nodes=()):
+        self.nodes = dict()
+        self.by_mac = dict()
+        self.adjacency = dict()
+        self.gateway = dict()
+        self.hops = dict()
+        self.descendants = dict()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        """Add a Node to the index."""
+        self.nodes[node.id] = node
+        if node.mac:
+            self.by_mac[node.mac.lower()] = node
+
+        links = self.adjacency.setdefault(node.id, set())
+        for neighbor, link in node.get_neighbors():
+            links.add(neighbor)
+            self.adjacency.setdefault(neighbor, set()).add(node.id)
+
+        gateway = node.get_gateway()
+        if gateway is None:
+            return
+        self.gateway[node.id] = gateway
+        self.descendants.setdefault(gateway, set()).add(node.id)
+        self.hops[node.id] = self.get_hop_count(node, gateway)
+
+    @staticmethod
+    def get_hop_count(node, gateway):
+        """Return the number of hops from a node to its gateway, or None."""
+        if node.id == gateway:
+            return 0
+        if isinstance(node.selected_gateway, dict):
+            hops = node.selected_gateway.get('hops')
+            if isinstance(hops, int):
+                return hops
+        path = node.get_gateway_path()
+        if path and path[0] == node.id:
+            path = path[1:]
+        if path:
+            return len(path)
+        return None
+
+    def get_node(self, key):
+        """Return the Node for a node ID or MAC address, or None."""
+        if key in self.nodes:
+            return self.nodes[key]
+        if hasattr(key, 'lower'):
+            return self.by_mac.get(key.lower())
+        return None
+
+    def get_neighbors(self, nodeid):
+        """Return the set of node IDs adjacent to a node."""
+        return self.adjacency.get(nodeid, set())
+
+    def get_gateway(self, nodeid):
+        """Return the node ID of the gateway a node routes through."""
+        return self.gateway.get(nodeid)
+
+    def get_repeaters(self, gateway):
+        """Return the Nodes which route through a gateway, excluding itself."""
+        return [self.nodes[x] for x in self.descendants.get(gateway, ())
+                if x != gateway and x in self.nodes]
+
+    def get_hop_distribution(self, network=None):
+        """Return a Counter of hop counts, optionally for a single network.
+
+        Nodes with an unknown hop count are counted under None.
+        """
+        result = Counter()
+        for nodeid, node in self.nodes.iteritems():
+            if network is not None and node.network != network:
+                continue
+            result[self.hops.get(nodeid)] += 1
+        return result
+
+    def get_client_traffic(self, clients):
+        """Return total client (download, upload) keyed by gateway node ID.
+
+        Clients are attributed to the gateway of the node they were last seen
+        on.  Clients whose node or gateway is not known are skipped.
+        """
+        result = dict()
+        for client in clients:
+            node = self.get_node(client.last_node)
+            if node is None:
+                continue
+            gateway = self.gateway.get(node.id)
+            if gateway is None:
+                continue
+            down, up = client.get_total_traffic()
+            total = result.setdefault(gateway, [0, 0])
+            total[0] += down
+            total[1] += up
+        return dict((k, tuple(v)) for k, v in result.iteritems())
+
+    def get_rows(self):
+        """Return (network, node ID, gateway ID, hops) for each node."""
+        return [(node.network, nodeid, self.gateway.get(nodeid),
+                 self.hops.get(nodeid))
+                for nodeid, node in self.nodes.iteritems()]
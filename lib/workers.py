@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""lib/workers.py
+
+Thread pool helper for cloudscraper.
+
+© 2016 The Goulburn Group http://www.goulburngroup.com.au, all rights reserved.
+
+Authors:
+    Alex Ferrara <alex@receptiveit.com.au>
+    Brendan Jurd <direvus@gmail.com>
+"""
+from Queue import Queue
+import logging
+import sys
+import threading
+
+
+# The three-argument raise, which keeps the original traceback, is not valid
+# syntax in Python 3, so it is compiled at run time, as six.reraise does.
+if sys.version_info[0] < 3:
+    exec('def reraise(exc_type, exc_value, exc_tb):\n'
+            '    raise exc_type, exc_value, exc_tb\n')
+else:
+    def reraise(exc_type, exc_value, exc_tb):
+        raise exc_value.with_traceback(exc_tb)
+
+
+def run_parallel(func, items, workers=1):
+    """Call func on each item using a pool of threads.
+
+    Return a list of the results, in the same order as 'items'.  If any call
+    raises an exception, the remaining items are still processed and the
+    first exception is then re-raised in the calling thread.
+
+    With a single worker, the items are simply processed in turn in the
+    calling thread.
+    """
+    items = list(items)
+    workers = max(1, min(int(workers), len(items)))
+    if workers == 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    queue = Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def work():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Exception:
+                return
+            try:
+                results[index] = func(item)
+            except BaseException:
+                logging.exception("Worker failed on %r", item)
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=work) for x in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        reraise(*errors[0])
+    return results